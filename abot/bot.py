@@ -12,10 +12,11 @@ import re
 import typing
 from asyncio.events import AbstractEventLoop
 from inspect import iscoroutinefunction
-from typing import List, Optional
+from typing import DefaultDict, Dict, List, Optional, Set, Tuple
 
-from abot.cli import CommandCollection, Group
-from abot.util import iterator_merge
+from abot.cli import CommandCollection, Group, make_sync_executor, sync_executor
+from abot.transport import HttpTransport
+from abot.util import IteratorMerger, TaskRegistry
 
 logger = logging.getLogger(__name__)
 
@@ -45,6 +46,17 @@ class Backend:
         """
         raise NotImplementedError()
 
+    def use_transport(self, transport: HttpTransport):
+        """Receive the HttpTransport the Backend should create its HTTP sessions from.
+
+        It is called by the Bot when the Backend is attached, before
+        initialization.
+        """
+        self.transport = transport
+
+    async def shutdown(self):
+        """Release whatever the Backend holds, like its HTTP sessions, once the Bot stops running."""
+
     def whoami(self) -> Optional['Entity']:
         """Return whatever Entity identify the current Backend instance.
 
@@ -63,20 +75,59 @@ class Backend:
         """
         raise NotImplementedError()
 
-    def is_mentioned(self, message_event: 'MessageEvent') -> Optional[str]:
+    # Characters that may precede the name of the Backend when mentioning it
+    mention_prefixes = '@!'
+    # Characters that fit in a single message, None if there is no limit
+    max_message_length: Optional[int] = None
+
+    def mention_aliases(self) -> Iterable:
+        """Return other names the Backend answers to, besides its whoami() username."""
+        return ()
+
+    def get_mention_matcher(self) -> Optional['MentionMatcher']:
+        """Return the MentionMatcher for the current identity, compiling it only if it changed."""
         whoami = self.whoami()
         if not whoami:
             return None
-        username = whoami.username
-        text = message_event.text
-        if not (username and text):
+        aliases = (whoami.username, *self.mention_aliases())
+        matcher: Optional[MentionMatcher] = getattr(self, '_mention_matcher', None)
+        if matcher is None or matcher.key != (aliases, self.mention_prefixes):
+            matcher = self._mention_matcher = MentionMatcher(aliases, self.mention_prefixes)
+        return matcher
+
+    def is_mentioned(self, message_event: 'MessageEvent') -> Optional[str]:
+        matcher = self.get_mention_matcher()
+        if not matcher:
             return None
-        if len(text) < 2:
+        return matcher.match(message_event.text)
+
+
+class MentionMatcher:
+    """Tell whether a text starts by mentioning one of the aliases.
+
+    A mention is an alias, optionally preceded by one of the prefixes, and
+    followed by `,`, `:`, a space or the end of the text.
+    """
+
+    def __init__(self, aliases: Iterable, prefixes: str = '@!'):
+        aliases = tuple(aliases)
+        self.key = (aliases, prefixes)
+        self.aliases = tuple(alias for alias in aliases if alias and isinstance(alias, str))
+        self.first_chars = frozenset(prefixes) | frozenset(alias[0] for alias in self.aliases)
+        # Longest first, so that an alias that is a prefix of another does not shadow it
+        alternatives = '|'.join(re.escape(alias) for alias in sorted(self.aliases, key=len, reverse=True))
+        prefix = f'[{re.escape(prefixes)}]?' if prefixes else ''
+        self.pattern = re.compile(f'{prefix}({alternatives})(?:[,:\\s]|$)')
+
+    def __bool__(self):
+        return bool(self.aliases)
+
+    def match(self, text: str) -> Optional[str]:
+        if not text or len(text) < 2 or text[0] not in self.first_chars:
             return None
-        pattern = r'^(@|!)?' + username + r'(([,:]|\s)|$)'
-        logger.debug(f'Checking if `{text}` matches {pattern}')
-        if re.match(pattern, text):
-            return username
+        match = self.pattern.match(text)
+        if match:
+            return match.group(1)
         return None
 
 
@@ -149,6 +200,11 @@ class Event(BotObject):
         # Reply to the message mentioning if possible
         raise NotImplementedError()
 
+    @property
+    def reply_max_length(self) -> Optional[int]:
+        """Characters of text that fit in a single reply, None if there is no limit."""
+        return self.backend.max_message_length
+
 
 class MessageEvent(Event):
     @property
@@ -237,15 +293,24 @@ current_bot: 'contextvars.ContextVar[Bot]' = contextvars.ContextVar('current_bot
 
 
 class Bot:
-    def __init__(self):
-        self.backends = {}
-        self.event_handlers = defaultdict(set)
-        self.message_handlers = set()
-        self.forever_loop: asyncio.Future = None
+    # Key under which command executions are accounted in the task registry
+    COMMANDS_TASK_KEY = 'commands'
+
+    def __init__(self, *, max_tasks: Optional[int] = None, max_tasks_per_handler: Optional[int] = None,
+                 http_config: Optional[dict] = None):
+        self.backends: Dict[Backend, typing.AsyncIterator] = {}
+        self.http = HttpTransport(**(http_config or {}))
+        self.event_handlers: DefaultDict[typing.Callable, Set[type]] = defaultdict(set)
+        self.event_dispatch: Dict[type, Tuple[typing.Callable, ...]] = {}
+        self.message_handlers: Set[Group] = set()
+        self._command_collection: Optional[CommandCollection] = None
+        self.tasks = TaskRegistry(limit=max_tasks, key_limit=max_tasks_per_handler)
+        self.forever_loop: Optional[asyncio.Future] = None
 
     def attach_backend(self, backend: Backend):
         if backend in self.backends:
             raise ValueError(f'Backend {backend} is already attached to bot')
+        backend.use_transport(self.http)
         iterator = self.backend_consume(backend)
         self.backends[backend] = iterator
 
@@ -261,15 +326,23 @@ class Bot:
                 logger.exception(f'Exception in {backend} handled. Trying to recover.')
 
     def attach_command_group(self, group: Group):
+        if group in self.message_handlers:
+            return
         self.message_handlers.add(group)
+        self._command_collection = None
+
+    @property
+    def command_collection(self) -> CommandCollection:
+        if self._command_collection is None:
+            self._command_collection = CommandCollection(sources=self.message_handlers)
+        return self._command_collection
 
     async def _handle_message(self, message: MessageEvent):
         name = message.backend.is_mentioned(message)
         if not name:
             return
         logger.info(f'Executing command: {message.text}')
-        cmd = CommandCollection(sources=self.message_handlers)
-        asyncio.ensure_future(cmd.async_message(message))
+        await self.tasks.spawn(self.command_collection.async_message(message), key=self.COMMANDS_TASK_KEY)
 
     def add_event_handler(self, event_class_or_func=None, *, func=None):
         if iscoroutinefunction(event_class_or_func):
@@ -290,6 +363,7 @@ class Bot:
 
             for ec in event_class:
                 self.event_handlers[f].add(ec)
+            self.event_dispatch.clear()
             return f
 
         if func is None:
@@ -302,35 +376,74 @@ class Bot:
         if isinstance(event, MessageEvent):
             logger.debug(f'Handling message {event.text}')
             await self._handle_message(event)
-        runs = 0
-        for cls in inspect.getmro(event.__class__):
-            for handler, handled_classes in self.event_handlers.items():
-                if cls not in handled_classes:
-                    continue
-                asyncio.ensure_future(self.run_event(handler, event))
-                runs += 1
-        if not runs:
+        handlers = self.get_event_handlers(event.__class__)
+        for handler in handlers:
+            await self.tasks.spawn(self.run_event(handler, event), key=handler)
+        if not handlers:
             logger.debug(f'No message handler for {event}')
 
+    def get_event_handlers(self, event_class) -> tuple:
+        """Return the handlers to run for an Event class, in dispatch order.
+
+        The result is computed the first time an Event class is seen and kept
+        in `event_dispatch` until a new handler is registered.
+        """
+        try:
+            return self.event_dispatch[event_class]
+        except KeyError:
+            pass
+        found = []
+        for cls in inspect.getmro(event_class):
+            for handler, handled_classes in self.event_handlers.items():
+                if cls in handled_classes:
+                    found.append(handler)
+        handlers = self.event_dispatch[event_class] = tuple(found)
+        return handlers
+
     async def _run_forever(self):
         continue_running = True
 
         for backend in self.backends:
             await backend.initialize()
 
-        backend_iterators = {i: None for i in self.backends.values()}
+        events = IteratorMerger(self.backends.values())
+        # Sync commands run in threads of this Bot, other Bots and async_main callers keep their own
+        executor = make_sync_executor()
+        executor_token = sync_executor.set(executor)
 
-        while continue_running:
-            try:
-                async for event in iterator_merge(backend_iterators):
-                    ce_token = current_event.set(event)
-                    await self._handle_event(event=event)
-                    current_event.reset(ce_token)
-            except Abort as e:
-                logger.info(f'Execution aborted by {e}')
-                raise e from None
-            except Exception as e:
-                continue_running = await self.internal_exception_handler(e)
+        try:
+            while continue_running:
+                try:
+                    async for event in events:
+                        ce_token = current_event.set(event)
+                        await self._handle_event(event=event)
+                        current_event.reset(ce_token)
+                    continue_running = False
+                except Abort as e:
+                    logger.info(f'Execution aborted by {e}')
+                    raise e from None
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    continue_running = await self.internal_exception_handler(e)
+                    if continue_running and events.closed:
+                        # A failing backend iterator stops the rest with it, start consuming all of them again
+                        logger.warning('Backend iterators stopped, restarting them')
+                        for backend in self.backends:
+                            self.backends[backend] = self.backend_consume(backend)
+                        events = IteratorMerger(self.backends.values())
+        finally:
+            await events.aclose()
+            # Handlers still running would otherwise use backends, transport and executor after they are closed
+            await self.tasks.cancel_all()
+            for backend in self.backends:
+                try:
+                    await backend.shutdown()
+                except Exception:
+                    logger.exception(f'Failed to shut down {backend}')
+            await self.http.close()
+            sync_executor.reset(executor_token)
+            executor.shutdown(wait=False)
 
     async def run_forever(self):
         cbt = current_bot.set(self)
@@ -6,17 +6,116 @@ import click
 import click._unicodefun  # type: ignore
 import click.core
 import click.utils
+import contextvars
+import copy
+import inspect
 import logging
+import os
 import shlex
+import sys
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Awaitable, Deque, List, NamedTuple, Optional, Sequence, Tuple, TYPE_CHECKING
+
+from abot.util import chunk_text, LRUCache
 
 # Allow type checking for circular dependencies
-from typing import TYPE_CHECKING
 if TYPE_CHECKING:
     import abot
 
 logger = logging.getLogger(__name__)
 
-tbd_tasks = []
+# Replies produced while parsing a message (e.g. help), sent before its command runs
+deferred_replies: 'contextvars.ContextVar[Optional[Deque[Awaitable]]]' = contextvars.ContextVar(
+    'deferred_replies', default=None)
+
+
+def defer_reply(reply: Awaitable):
+    """Queue a reply in the invocation being parsed, outside of one it is sent right away."""
+    replies = deferred_replies.get()
+    if replies is None:
+        asyncio.ensure_future(reply)
+    else:
+        replies.append(reply)
+
+
+async def send_deferred_replies():
+    replies = deferred_replies.get()
+    while replies:
+        await replies.popleft()
+
+
+# Contexts made while parsing a message, so that the parse can be cached
+parsed_contexts: 'contextvars.ContextVar[Optional[List[click.Context]]]' = contextvars.ContextVar(
+    'parsed_contexts', default=None)
+
+
+class ParsedContext(NamedTuple):
+    command: click.Command
+    info_name: str
+    params: dict
+    args: list
+    invoked_subcommand: Optional[str]
+
+
+# Bumped every time a command is attached to a Group or a source to a
+# CommandCollection, so that anything precomputed from the command tree
+# knows when it has become stale.
+command_tree_revision = 0
+
+
+# Threads running the callbacks of sync commands, so they don't block the event loop
+SYNC_COMMAND_WORKERS = 4
+_sync_executor: Optional[ThreadPoolExecutor] = None
+
+# Executor the sync commands of the current invocation run in, set by whoever owns it (e.g. a Bot). The shared
+# module executor is used when unset.
+sync_executor: 'contextvars.ContextVar[Optional[Executor]]' = contextvars.ContextVar('sync_executor', default=None)
+
+
+def make_sync_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=SYNC_COMMAND_WORKERS, thread_name_prefix='abot-command')
+
+
+def get_sync_executor() -> Executor:
+    executor = sync_executor.get()
+    if executor is not None:
+        return executor
+    global _sync_executor
+    if _sync_executor is None:
+        _sync_executor = make_sync_executor()
+    return _sync_executor
+
+
+def shutdown_sync_executor(wait=True):
+    """Shut down the shared executor, executors set through `sync_executor` are shut down by their owners."""
+    global _sync_executor
+    executor, _sync_executor = _sync_executor, None
+    if executor is not None:
+        executor.shutdown(wait=wait)
+
+
+async def run_sync_callback(ctx, callback, *args, **kwargs):
+    """Run a sync callback in the sync executor, with the click context and context variables of the caller."""
+    def run():
+        with ctx.scope(cleanup=False):
+            return callback(*args, **kwargs)
+
+    loop = asyncio.get_event_loop()
+    result = await loop.run_in_executor(get_sync_executor(), contextvars.copy_context().run, run)
+    if inspect.isawaitable(result):
+        result = await result
+    return result
+
+
+def run_coroutine(coroutine):
+    """Run a coroutine to completion from sync code, which cannot happen inside a running event loop."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.get_event_loop().run_until_complete(coroutine)
+    coroutine.close()
+    raise RuntimeError('Cannot invoke commands synchronously from a running event loop, use async_main instead')
 
 
 class ExitCode(Exception):
@@ -38,25 +137,41 @@ class Context(click.Context):
         args = args[2:]
         with click.core.augment_usage_errors(self):
             with ctx:
-                return await callback(*args, **kwargs)
+                if asyncio.iscoroutinefunction(inspect.unwrap(callback)):
+                    return await callback(*args, **kwargs)
+                return await run_sync_callback(ctx, callback, *args, **kwargs)
 
     def exit(self, code=0):
         raise ExitCode(code=code)
 
 
 class AsyncCommandMixin:
+    # Help option and option parser built for the current parameters, reused across parses
+    _help_option = None
+    _parser_schema = None
+    # Help texts formatted for each command path, along with the command tree revision they were formatted at
+    _help_texts: Optional[Tuple[int, dict]] = None
+
     def invoke(self, ctx):
         """Given a context, this invokes the attached callback (if it exists)
         in the right way.
         """
         if self.callback is not None:
-            loop = asyncio.get_event_loop()
-            return loop.run_until_complete(self.async_invoke(ctx))
+            return run_coroutine(self.async_invoke(ctx))
 
     async def async_invoke(self, ctx):
         if self.callback is not None:
             return await ctx.async_invoke(self.callback, **ctx.params)
 
+    async def async_main(self, args=None, prog_name=None, **extra):
+        """Parse the arguments and invoke the command in the running event loop, the async version of `main`."""
+        if args is None:
+            args = sys.argv[1:]
+        if prog_name is None:
+            prog_name = os.path.basename(sys.argv[0])
+        with self.make_context(prog_name, list(args), **extra) as ctx:
+            return await self.async_invoke(ctx)
+
     def make_context(self, info_name, args, parent=None, **extra):
         for key, value in self.context_settings.items():
             if key not in extra:
@@ -64,6 +179,9 @@ class AsyncCommandMixin:
         ctx = Context(self, info_name=info_name, parent=parent, **extra)
         with ctx.scope(cleanup=False):
             self.parse_args(ctx, args)
+        contexts = parsed_contexts.get()
+        if contexts is not None:
+            contexts.append(ctx)
         return ctx
 
     def get_help_option(self, ctx):
@@ -71,18 +189,76 @@ class AsyncCommandMixin:
         help_options = self.get_help_option_names(ctx)
         if not help_options or not self.add_help_option:
             return
-
-        def show_help(ctx, param, value):
-            import abot.bot
-            if value and not ctx.resilient_parsing:
-                event: abot.bot.MessageEvent = abot.bot.current_event.get()
-                tbd_tasks.append(event.reply(ctx.get_help()))
-                ctx.exit()
-
-        return click.core.Option(help_options, is_flag=True,
-                                 is_eager=True, expose_value=False,
-                                 callback=show_help,
-                                 help='Show this message and exit.')
+        key = frozenset(help_options)
+        if self._help_option is None or self._help_option[0] != key:
+            self._help_option = key, HelpOption(sorted(help_options, key=len), is_flag=True,
+                                                is_eager=True, expose_value=False,
+                                                callback=show_help,
+                                                help='Show this message and exit.')
+        return self._help_option[1]
+
+    def get_help(self, ctx):
+        """Formats the help into a string, reusing the text formatted for the same command path."""
+        texts = self._get_help_texts()
+        key = self._help_key(ctx)
+        text = texts.get(key)
+        if text is None:
+            text = texts[key] = super().get_help(ctx)
+        return text
+
+    def get_help_blocks(self, ctx, max_length=None) -> Tuple[str, ...]:
+        """The help split into messages of up to `max_length` characters."""
+        texts = self._get_help_texts()
+        key = (self._help_key(ctx), max_length)
+        blocks = texts.get(key)
+        if blocks is None:
+            blocks = texts[key] = tuple(chunk_text(self.get_help(ctx), max_length))
+        return blocks
+
+    def _help_key(self, ctx):
+        return ctx.command_path, ctx.terminal_width, ctx.max_content_width, tuple(self.params)
+
+    def _get_help_texts(self) -> dict:
+        if self._help_texts is None or self._help_texts[0] != command_tree_revision:
+            texts: dict = {}
+            self._help_texts = command_tree_revision, texts
+            return texts
+        return self._help_texts[1]
+
+    def make_parser(self, ctx):
+        """Creates the underlying option parser for this command, copying the one built for its parameters."""
+        key = (tuple(self.params), self.get_help_option(ctx), ctx.token_normalize_func)
+        if self._parser_schema is None or self._parser_schema[0] != key:
+            template = super().make_parser(ctx)
+            template.ctx = None
+            self._parser_schema = key, template
+        parser = copy.copy(self._parser_schema[1])
+        parser.ctx = ctx
+        parser.allow_interspersed_args = ctx.allow_interspersed_args
+        parser.ignore_unknown_options = ctx.ignore_unknown_options
+        return parser
+
+
+def reply_help(ctx):
+    """Reply to the current event with the help of the command being parsed, in blocks its backend can send."""
+    import abot.bot
+    event: abot.bot.MessageEvent = abot.bot.current_event.get()
+    try:
+        max_length = event.reply_max_length
+    except NotImplementedError:
+        max_length = None
+    for block in ctx.command.get_help_blocks(ctx, max_length):
+        defer_reply(event.reply(block))
+
+
+def show_help(ctx, param, value):
+    if value and not ctx.resilient_parsing:
+        reply_help(ctx)
+        ctx.exit()
+
+
+class HelpOption(click.core.Option):
+    pass
 
 
 class Command(AsyncCommandMixin, click.Command):
@@ -91,13 +267,9 @@ class Command(AsyncCommandMixin, click.Command):
 
 class AsyncMultiCommandMixin(AsyncCommandMixin):
     def invoke(self, ctx):
-        args = ctx.protected_args + ctx.args
-        _, cmd, _ = self.resolve_command(ctx, args)
-        if ctx.__class__ != Context or isinstance(cmd, click.Command):
-            click.MultiCommand.invoke(self, ctx)
-        else:
-            loop = asyncio.get_event_loop()
-            return loop.run_until_complete(self.async_invoke(ctx))
+        if ctx.__class__ != Context:
+            return click.MultiCommand.invoke(self, ctx)
+        return run_coroutine(self.async_invoke(ctx))
 
     async def async_invoke(self, ctx):
         async def _process_result(value):
@@ -146,13 +318,11 @@ class AsyncMultiCommandMixin(AsyncCommandMixin):
             for sub_ctx in contexts:
                 with sub_ctx:
                     rv.append(await sub_ctx.command.async_invoke(sub_ctx))
-            return _process_result(rv)
+            return await _process_result(rv)
 
     def parse_args(self, ctx, args):
-        import abot.bot
         if not args and self.no_args_is_help and not ctx.resilient_parsing:
-            event: abot.bot.MessageEvent = abot.bot.current_event.get()
-            tbd_tasks.append(event.reply(ctx.get_help()))
+            reply_help(ctx)
             ctx.exit()
         super().parse_args(ctx, args)
 
@@ -162,6 +332,11 @@ class MultiCommand(AsyncMultiCommandMixin, click.MultiCommand):
 
 
 class AsyncGroupMixin(AsyncMultiCommandMixin):
+    def add_command(self, cmd, name=None):
+        global command_tree_revision
+        super().add_command(cmd, name)
+        command_tree_revision += 1
+
     def command(self, *args, **kwargs):
         kwargs.setdefault('cls', Command)
         return super().command(*args, **kwargs)
@@ -182,39 +357,154 @@ class Group(AsyncGroupMixin, click.Group):
 
 
 class AsyncCommandCollection(AsyncMultiCommandMixin):
+    # Messages whose arguments are kept, and argument lists whose parse results are kept
+    ARGV_CACHE_SIZE = 1024
+    PARSE_CACHE_SIZE = 256
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.argv_cache = LRUCache(self.ARGV_CACHE_SIZE)
+        self.parse_cache = LRUCache(self.PARSE_CACHE_SIZE)
+        self._parse_cache_revision = command_tree_revision
+        self._cacheable_commands = {}
+
+    def split_message(self, text) -> Tuple[str, ...]:
+        argv = self.argv_cache.get(text)
+        if argv is None:
+            argv = tuple(shlex.split(text))
+            self.argv_cache.put(text, argv)
+        return argv
+
+    def get_parse(self, argv) -> Optional[Tuple[ParsedContext, ...]]:
+        if self._parse_cache_revision != command_tree_revision:
+            self.parse_cache.clear()
+            self._cacheable_commands.clear()
+            self._parse_cache_revision = command_tree_revision
+        return self.parse_cache.get(argv)
+
     async def async_message(self, message: 'abot.bot.MessageEvent'):
-        args = shlex.split(message.text)
-        if not args:
+        argv = self.split_message(message.text)
+        if not argv:
             return
-        prog_name = args.pop(0)
+        token = deferred_replies.set(deque())
         try:
             try:
-                with self.make_context(prog_name, args) as ctx:
-                    for task in list(tbd_tasks):
-                        await task
-                        tbd_tasks.remove(task)
-                    await self.async_invoke(ctx)
+                parse = self.get_parse(argv)
+                if parse is None:
+                    await self.parse_and_invoke(argv)
+                else:
+                    await self.invoke_parse(parse)
             except click.ClickException as e:
-                for task in list(tbd_tasks):
-                    await task
-                    tbd_tasks.remove(task)
+                await send_deferred_replies()
                 await message.reply(e.format_message())
             except click.Abort:
-                for task in list(tbd_tasks):
-                    await task
-                    tbd_tasks.remove(task)
+                await send_deferred_replies()
                 await message.reply('Aborted!')
         except ExitCode as e:
-            for task in list(tbd_tasks):
-                await task
-                tbd_tasks.remove(task)
+            await send_deferred_replies()
             logger.debug(f'Command exited {e}', exc_info=True)
             if e.code:
-                message.reply('Exception happened, contact developers')
+                await message.reply('Exception happened, contact developers')
+        finally:
+            deferred_replies.reset(token)
+
+    async def parse_and_invoke(self, argv):
+        contexts = []
+        token = parsed_contexts.set(contexts)
+        try:
+            with self.make_context(argv[0], list(argv[1:])) as ctx:
+                await send_deferred_replies()
+                await self.async_invoke(ctx)
+        finally:
+            parsed_contexts.reset(token)
+        parse = self.cacheable_parse(contexts)
+        if parse:
+            self.parse_cache.put(argv, parse)
+
+    async def invoke_parse(self, parse: Sequence[ParsedContext], parent=None):
+        """Invoke the commands of a cached parse, as async_invoke would have after parsing."""
+        parsed, *subcommands = parse
+        command = parsed.command
+        ctx = Context(command, info_name=parsed.info_name, parent=parent, **command.context_settings)
+        ctx.params.update(parsed.params)
+        ctx.args = list(parsed.args)
+        with ctx:
+            ctx.invoked_subcommand = parsed.invoked_subcommand
+            await Command.async_invoke(command, ctx)
+            if subcommands:
+                await self.invoke_parse(subcommands, parent=ctx)
+
+    def cacheable_parse(self, contexts) -> Optional[Tuple[ParsedContext, ...]]:
+        """The parse done through `contexts` if invoking it again gives the same result, None otherwise."""
+        parse = []
+        parent = None
+        for ctx in contexts:
+            if ctx.parent is not parent or ctx.auto_envvar_prefix:
+                return None
+            cacheable = self._cacheable_commands.get(ctx.command)
+            if cacheable is None:
+                cacheable = self._cacheable_commands[ctx.command] = self.is_cacheable_command(ctx)
+            if not cacheable:
+                return None
+            parse.append(ParsedContext(ctx.command, ctx.info_name, dict(ctx.params), list(ctx.args),
+                                       ctx.invoked_subcommand))
+            parent = ctx
+        if not parse or parse[-1].invoked_subcommand is not None:
+            return None
+        return tuple(parse)
+
+    @staticmethod
+    def is_cacheable_command(ctx) -> bool:
+        command = ctx.command
+        if not isinstance(command, AsyncCommandMixin) or not isinstance(command, click.Command):
+            return False
+        if getattr(command, 'chain', False) or getattr(command, 'result_callback', None):
+            return False
+        for param in command.get_params(ctx):
+            if param.callback is not None and not isinstance(param, HelpOption):
+                return False
+            if callable(param.default) or param.envvar or getattr(param, 'prompt', None):
+                return False
+            if isinstance(param.type, (click.File, click.Path)):
+                return False
+        return True
 
 
 class CommandCollection(AsyncCommandCollection, click.CommandCollection):
-    pass
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._command_index = None
+        self._command_index_revision = None
+
+    @property
+    def command_index(self):
+        """Name to command mapping across all the sources, if they allow it.
+
+        Only sources that are `click.Group` instances expose their commands
+        without a Context, if any other kind of source is present this is None
+        and lookups fall back to walking the sources.
+        """
+        if self._command_index_revision != command_tree_revision:
+            self._command_index = None
+            if all(isinstance(source, click.Group) for source in self.sources):
+                index = {}
+                # Walk backwards so the first source wins, as in click
+                for source in reversed(list(self.sources)):
+                    index.update(source.commands)
+                self._command_index = index
+            self._command_index_revision = command_tree_revision
+        return self._command_index
+
+    def add_source(self, multi_cmd):
+        global command_tree_revision
+        super().add_source(multi_cmd)
+        command_tree_revision += 1
+
+    def get_command(self, ctx, cmd_name):
+        index = self.command_index
+        if index is None or self.chain:
+            return super().get_command(ctx, cmd_name)
+        return index.get(cmd_name)
 
 
 def command(name=None, **attrs):
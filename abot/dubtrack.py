@@ -3,12 +3,11 @@ from __future__ import absolute_import, print_function, unicode_literals
 
 import time
 from collections import defaultdict
-from typing import Optional
+from typing import Dict, Optional
 
 import aiohttp
 import asyncio
 import datetime
-import json
 import logging
 import pprint
 import random
@@ -17,12 +16,15 @@ import weakref
 from yarl import URL
 
 from abot.bot import Backend, BotObject, Channel, Entity, Event, MessageEvent
+from abot.util import chunk_text, json_codec, retrieve_exception, TokenBucket
 
 logger = logging.getLogger('abot.dubtrack')
 logger_layer1 = logging.getLogger('abot.dubtrack.layer1')
 logger_layer2 = logging.getLogger('abot.dubtrack.layer2')
 logger_layer3 = logging.getLogger('abot.dubtrack.layer3')
 
+logger_http = logging.getLogger('abot.dubtrack.http')
+
 logger_layer1.propagate = False
 logger_layer2.propagate = False
 logger_layer3.propagate = False
@@ -40,16 +42,72 @@ class DubtrackObject(BotObject):
 
 
 class DubtrackChannel(DubtrackObject, Channel):
+    # Chat messages sent per second, and how many can be sent at once after being idle
+    SAY_RATE = 2
+    SAY_BURST = 3
+    # Characters sent in a single chat message, longer lines are split
+    SAY_MAX_LENGTH = 140
+    # Consecutive lines are joined into messages of up to this length, 0 disables it
+    SAY_COALESCE_LENGTH = 0
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._dubtrack_backend._register_user(self._data)
+        self._say_bucket = TokenBucket(self.SAY_RATE, self.SAY_BURST)
+        self._outbox: Optional[asyncio.Queue] = None
+        self._sender: Optional[asyncio.Future] = None
 
-    async def say(self, text: str):
+    async def say(self, text: str) -> asyncio.Future:
+        """Queue the text to be sent to the room, one message per line.
+
+        Returns a future which resolves once the last message is sent, or
+        fails with the exception raised while sending any of them.
+        """
         if not self._dubtrack_backend.dubtrack_id:
             raise ValueError('You need to login to speak')
-        for line in text.splitlines():
-            await self._dubtrack_backend.dubtrackws.say_in_room(line)
-            await asyncio.sleep(0.5)
+        delivered = asyncio.get_event_loop().create_future()
+        # Most callers don't wait for the delivery, failures are logged when sending
+        delivered.add_done_callback(retrieve_exception)
+        lines = [chunk for line in text.splitlines() for chunk in chunk_text(line, self.SAY_MAX_LENGTH)]
+        messages = self._coalesce(lines)
+        if not messages:
+            delivered.set_result(None)
+            return delivered
+        if self._outbox is None:
+            self._outbox = asyncio.Queue()
+        last_index = len(messages) - 1
+        for index, message in enumerate(messages):
+            self._outbox.put_nowait((message, delivered, index == last_index))
+        if self._sender is None or self._sender.done():
+            self._sender = asyncio.ensure_future(self._send_outbox())
+        return delivered
+
+    def _coalesce(self, lines):
+        max_length = self.SAY_COALESCE_LENGTH
+        if not max_length:
+            return lines
+        messages = []
+        for line in lines:
+            if messages and len(messages[-1]) + len(line) + 1 <= max_length:
+                messages[-1] = f'{messages[-1]}\n{line}'
+            else:
+                messages.append(line)
+        return messages
+
+    async def _send_outbox(self):
+        while not self._outbox.empty():
+            message, delivered, last = self._outbox.get_nowait()
+            if delivered.done():  # A previous message of the same text failed
+                continue
+            await self._say_bucket.acquire()
+            try:
+                await self._dubtrack_backend.dubtrackws.say_in_room(message)
+            except Exception as e:
+                logger.exception(f'Failed to say {message}')
+                delivered.set_exception(e)
+            else:
+                if last:
+                    delivered.set_result(None)
 
     @property
     def entities(self):
@@ -117,14 +175,38 @@ class DubtrackEntity(DubtrackObject, Entity):
 
 class DubtrackEvent(DubtrackObject, Event):
     _data_type = ''
+    # Whether _data_type matches every type starting with it (e.g. user_update_<id>)
+    _data_type_prefix = False
+
+    # Event classes by the data type they handle, filled as they are defined
+    _event_classes: Dict[str, type] = {}
+    _event_class_prefixes: Dict[str, type] = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        data_type = cls.__dict__.get('_data_type')
+        if not data_type:
+            return
+        if cls._data_type_prefix:
+            DubtrackEvent._event_class_prefixes[data_type] = cls
+        else:
+            DubtrackEvent._event_classes[data_type] = cls
+
+    @classmethod
+    def get_event_class(cls, data_type: str) -> Optional[type]:
+        event_class = DubtrackEvent._event_classes.get(data_type)
+        if event_class is None:
+            for prefix, prefix_class in DubtrackEvent._event_class_prefixes.items():
+                if data_type.startswith(prefix):
+                    return prefix_class
+        return event_class
 
     @classmethod
     def from_data(cls, data, dubtrack_backend: 'DubtrackBotBackend'):
-        for cl in cls.__subclasses__():
-            if cl._data_type == data['type']:
-                return cl(data, dubtrack_backend)
-        else:
-            return cls(data, dubtrack_backend)
+        event_class = cls.get_event_class(data['type'])
+        if event_class is None or not issubclass(event_class, cls):
+            event_class = cls
+        return event_class(data, dubtrack_backend)
 
     @property
     def sender(self) -> DubtrackEntity:
@@ -431,6 +513,7 @@ class DubtrackUnSetRole(DubtrackEvent):
 
 class DubtrackUserUpdate(DubtrackEvent):
     _data_type = 'user_update'
+    _data_type_prefix = True
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -453,15 +536,67 @@ class DubtrackUserUpdate(DubtrackEvent):
 
 # Dubtrack bot plugin
 
+class DubtrackUserRegistry:
+    """Known Dubtrack users' data, indexed by id and by case insensitive username.
+
+    The dicts returned are the ones stored, so they are shared by every
+    DubtrackEntity built from them and updated in place.
+    """
+
+    def __init__(self):
+        self._users: Dict[str, dict] = {}
+        self._usernames: Dict[str, str] = {}
+
+    def __iter__(self):
+        return iter(self._users)
+
+    def __len__(self):
+        return len(self._users)
+
+    def __contains__(self, user_id):
+        return user_id in self._users
+
+    def get(self, id_or_name) -> Optional[dict]:
+        if not id_or_name:
+            return None
+        user = self._users.get(id_or_name)
+        if user is None and isinstance(id_or_name, str):
+            user_id = self._usernames.get(id_or_name.casefold())
+            if user_id is not None:
+                user = self._users[user_id]
+        return user
+
+    def update(self, user_id, fields: dict) -> dict:
+        user = self._users.get(user_id)
+        if user is None:
+            user = self._users[user_id] = {'id': user_id}
+        old_username = user.get('username')
+        user.update(fields)
+        username = user.get('username')
+        if username != old_username:
+            if old_username and self._usernames.get(old_username.casefold()) == user_id:
+                del self._usernames[old_username.casefold()]
+            if username:
+                self._usernames[username.casefold()] = user_id
+        return user
+
+
 class DubtrackBotBackend(Backend):
     # Official Bot methods
     def __init__(self, room):
         self.dubtrackws = DubtrackWS(room)
         self.dubtrack_channel = None
-        self.dubtrack_users = defaultdict(dict)  # ID: user_session_info
+        self.dubtrack_users = DubtrackUserRegistry()
         self.dubtrack_entities = weakref.WeakValueDictionary()
         self.dubtrack_id = None
 
+    def use_transport(self, transport):
+        super().use_transport(transport)
+        self.dubtrackws.transport = transport
+
+    async def shutdown(self):
+        await self.dubtrackws.close()
+
     def configure(self, *, username=None, password=None):
         if any((username, password)):
             self.dubtrackws.set_login(username, password)
@@ -493,10 +628,7 @@ class DubtrackBotBackend(Backend):
         if active_song:
             yield DubtrackPlaying(active_song, self)
         async for data in self.dubtrackws.ws_api_consume():
-            if data['type'].startswith('user_update'):
-                event = DubtrackUserUpdate(data, self)
-            else:
-                event = DubtrackEvent.from_data(data, self)
+            event = DubtrackEvent.from_data(data, self)
             event.channel = self.dubtrack_channel
             yield event
 
@@ -534,23 +666,11 @@ class DubtrackBotBackend(Backend):
         if not user_id:
             return
 
-        self.dubtrack_users[user_id].update(update_dict)
-
-        # Update entity if it exists... As it seems the dict is not updated
-        entity = self.dubtrack_entities.get(user_id)  # type: DubtrackEntity
-        if entity:
-            entity._data.update(update_dict)
+        # Entities share the registry dict, so they are updated too
+        self.dubtrack_users.update(user_id, update_dict)
 
     def _get_user_data(self, id_or_name):
-        for id, user_data in self.dubtrack_users.items():
-            if id_or_name == id:
-                data = {'id': id}
-                data.update(user_data)
-                return data
-            elif id_or_name == user_data.get('username'):
-                data = {'id': id}
-                data.update(user_data)
-                return data
+        return self.dubtrack_users.get(id_or_name)
 
     def _get_entity(self, id_or_name):
         user_data = self._get_user_data(id_or_name)
@@ -577,12 +697,596 @@ def gen_request_id():
     return ''.join(random.choices(string.ascii_letters + string.digits, k=44))
 
 
+class TracePayload:
+    """Payload of a request/response, only formatted when a log record actually renders it."""
+    __slots__ = ('payload', 'limit')
+
+    def __init__(self, payload, limit=None):
+        self.payload = payload
+        self.limit = limit
+
+    def __str__(self):
+        text = pprint.pformat(self.payload)
+        if self.limit and len(text) > self.limit:
+            text = f'{text[:self.limit]}... ({len(text) - self.limit} characters more)'
+        return text
+
+
+def describe_chat_message(content):
+    # {'chatid': '560b135c7ae1ea0300869b20-1518783003490',
+    #  'message': 'this is going goood :P',
+    #  'queue_object': {'__v': 0,
+    #                   '_id': '5628db0a3883a45600b7e68f',
+    #                   '_user': '560b135c7ae1ea0300869b20',
+    #                   'active': True,
+    #                   'authorized': True,
+    #                   'dubs': 368,
+    #                   'order': 99999,
+    #                   'ot_token': None,
+    #                   'playedCount': 1677,
+    #                   'queuePaused': None,
+    #                   'roleid': '52d1ce33c38a06510c000001',
+    #                   'roomid': '561b1e59c90a9c0e00df610b',
+    #                   'skippedCount': 0,
+    #                   'songsInQueue': 0,
+    #                   'updated': 1518771989676,
+    #                   'userid': '560b135c7ae1ea0300869b20',
+    #                   'waitLine': 0},
+    #  'time': 1518783003490,
+    #  'type': 'chat-message',
+    #  'user': {'__v': 0,
+    #           '_force_updated': 1516971162191,
+    #           '_id': '560b135c7ae1ea0300869b20',
+    #           'created': 1443566427591,
+    #           'dubs': 0,
+    #           'roleid': 1,
+    #           'status': 1,
+    #           'userInfo': {'__v': 0,
+    #                        '_id': '560b135c7ae1ea0300869b21',
+    #                        'userid': '560b135c7ae1ea0300869b20'},
+    #           'username': 'txomon'}}
+    chatid = content['chatid']
+    username = content['user']['username']
+    userid = content['user']['userInfo']['userid']
+    msg = content["message"]
+    return f'Chat {username}#{userid} (chatid#{chatid}): {msg}'
+
+
+def describe_chat_skip(content):
+    # {'type': 'chat-skip', 'username': 'txomon'}
+    username = content['username']
+    return f'Chat-skip by {username}'
+
+
+def describe_delete_chat_message(content):
+    # {'chatid': '560b135c7ae1ea0300869b20-1518784684020',
+    #  'type': 'delete-chat-message',
+    #  'user': {'__v': 0,
+    #           '_force_updated': 1516971162191,
+    #           '_id': '560b135c7ae1ea0300869b20',
+    #           'created': 1443566427591,
+    #           'dubs': 0,
+    #           'roleid': 1,
+    #           'status': 1,
+    #           'userInfo': {'__v': 0,
+    #                        '_id': '560b135c7ae1ea0300869b21',
+    #                        'userid': '560b135c7ae1ea0300869b20'},
+    #           'username': 'txomon'}}
+    username = content['user']['username']
+    userid = content['user']['userInfo']['userid']
+    chatid = content['chatid']
+    return f'User {username}#{userid} deleted {chatid}'
+
+
+def describe_room_playlist_dub(content):
+    # {'dubtype': 'downdub',
+    #  'playlist': {'__v': 0,
+    #               '_id': '5a8453cad51c3101003df01c',
+    #               '_song': '5a0db972fd20620100678621',
+    #               '_user': '56a80c626894b9410067b716',
+    #               'created': 1518621640481,
+    #               'downdubs': 1,
+    #               'isActive': True,
+    #               'isPlayed': False,
+    #               'order': 2,
+    #               'played': 1518782587986,
+    #               'roomid': '561b1e59c90a9c0e00df610b',
+    #               'skipped': False,
+    #               'songLength': 221000,
+    #               'songid': '5a0db972fd20620100678621',
+    #               'updubs': 0,
+    #               'userid': '56a80c626894b9410067b716'},
+    #  'type': 'room_playlist-dub',
+    #  'user': {'__v': 0,
+    #           '_force_updated': 1516971162191,
+    #           '_id': '560b135c7ae1ea0300869b20',
+    #           'created': 1443566427591,
+    #           'dubs': 0,
+    #           'roleid': 1,
+    #           'status': 1,
+    #           'userInfo': {'__v': 0,
+    #                        '_id': '560b135c7ae1ea0300869b21',
+    #                        'userid': '560b135c7ae1ea0300869b20'},
+    #           'username': 'txomon'}}
+    dubtype = content['dubtype']
+    username = content['user']['username']
+    userid = content['user']['userInfo']['userid']
+    downdubs = content['playlist']['downdubs']
+    updubs = content['playlist']['updubs']
+    return f"Song {dubtype} by {username}#{userid}, total {updubs}U/{downdubs}D"
+
+
+def describe_room_playlist_queue_reorder(content):
+    # {'type': 'room_playlist-queue-reorder',
+    #  'user': {'__v': 0,
+    #           '_force_updated': 1516971162191,
+    #           '_id': '560b135c7ae1ea0300869b20',
+    #           'created': 1443566427591,
+    #           'dubs': 0,
+    #           'roleid': 1,
+    #           'status': 1,
+    #           'userInfo': {'__v': 0,
+    #                        '_id': '560b135c7ae1ea0300869b21',
+    #                        'userid': '560b135c7ae1ea0300869b20'},
+    #           'username': 'txomon'}}
+    username = content['user']['username']
+    userid = content['user']['userInfo']['userid']
+    return f'User {username}#{userid} reordered the queue'
+
+
+def describe_room_playlist_queue_update_dub(content):
+    # {'type': 'room_playlist-queue-update-dub',
+    #  'user': {'__v': 0,
+    #           '_force_updated': 1499443841892,
+    #           '_id': '5628edc08d7d6a5600335d3d',
+    #           'created': 1445522880666,
+    #           'dubs': 0,
+    #           'roleid': 1,
+    #           'status': 1,
+    #           'userInfo': {'__v': 0,
+    #                        '_id': '5628edc08d7d6a5600335d3e',
+    #                        'userid': '5628edc08d7d6a5600335d3d'},
+    #           'username': 'iCel'}}
+    username = content['user']['username']
+    userid = content['user']['userInfo']['userid']
+    return f'User {username}/{userid} changed personal queue'
+
+
+def describe_room_playlist_update(content):
+    # {'startTime': -1,
+    #  'song': {'_id': '5a853a0a07f061010053d3c8',
+    #           'created': 1518680579959,
+    #           'isActive': True,
+    #           'isPlayed': False,
+    #           'skipped': False,
+    #           'order': 109,
+    #           'roomid': '561b1e59c90a9c0e00df610b',
+    #           'songLength': 194000,
+    #           'updubs': 0, 'downdubs': 0,
+    #           'userid': '56096ce7a98a6b0300144e33',
+    #           'songid': '584efe5534194d8400cfd013',
+    #           '_user': '56096ce7a98a6b0300144e33',
+    #           '_song': '584efe5534194d8400cfd013',
+    #           '__v': 0,
+    #           'played': 1518781826209},
+    #  'songInfo': {'_id': '584efe5534194d8400cfd013',
+    #               'name': 'Luis Alvarez - Final Time',
+    #               'images': {'thumbnail': 'https://i.ytimg.com/vi/KHkPbbdu5kk/hqdefault.jpg'},
+    #               'type': 'youtube',
+    #               'songLength': 194000,
+    #               'fkid': 'KHkPbbdu5kk',
+    #               '__v': 0,
+    #               'created': '2016-12-12T19:45:25.669Z'},
+    #  'type': 'room_playlist-update'}
+    songinfo = content['songInfo']
+    name = songinfo['name']
+    songtype = songinfo['type']
+    songid = songinfo['fkid']
+    return f'Now playing {songtype}#{songid}: {name}'
+
+
+def describe_user_join(content):
+    # {'roomUser': {'__v': 0,
+    #               '_id': '57f36aff34169c1a0018f92d',
+    #               '_user': '57f36acd6c9b5c5b003d41d2',
+    #               'active': False,
+    #               'authorized': True,
+    #               'dubs': 3533,
+    #               'order': 99999,
+    #               'ot_token': None,
+    #               'playedCount': 10862,
+    #               'queuePaused': None,
+    #               'roomid': '561b1e59c90a9c0e00df610b',
+    #               'skippedCount': 0,
+    #               'songsInQueue': 588,
+    #               'updated': 1518783589638,
+    #               'userid': '57f36acd6c9b5c5b003d41d2',
+    #               'waitLine': 0},
+    #  'type': 'user-join',
+    #  'user': {'__v': 0,
+    #           '_force_updated': 1504509671098,
+    #           '_id': '57f36acd6c9b5c5b003d41d2',
+    #           'created': 1475570381585,
+    #           'dubs': 0,
+    #           'roleid': 1,
+    #           'status': 1,
+    #           'userInfo': {'__v': 0,
+    #                        '_id': '57f36acd6c9b5c5b003d41d3',
+    #                        'userid': '57f36acd6c9b5c5b003d41d2'},
+    #           'username': 'eberg'}}
+    username = content['user']['username']
+    userid = content['user']['userInfo']['userid']
+    # TODO: Explore roomUser
+    return f'User {username}#{userid} joined'
+
+
+def describe_user_pause_queue(content):
+    # {'type': 'user-pause-queue',
+    #  'user': {'__v': 0,
+    #           '_force_updated': 1499443841892,
+    #           '_id': '5628edc08d7d6a5600335d3d',
+    #           'created': 1445522880666,
+    #           'dubs': 0,
+    #           'roleid': 1,
+    #           'status': 1,
+    #           'userInfo': {'__v': 0,
+    #                        '_id': '5628edc08d7d6a5600335d3e',
+    #                        'userid': '5628edc08d7d6a5600335d3d'},
+    #           'username': 'iCel'},
+    # 'user_queue': {'__v': 0,
+    #                '_id': '5628ededa2d0f81300edc39a',
+    #                '_user': '5628edc08d7d6a5600335d3d',
+    #                'active': True,
+    #                'authorized': True,
+    #                'dubs': 25899,
+    #                'order': 99999,
+    #                'ot_token': None,
+    #                'playedCount': 23897,
+    #                'queuePaused': None,
+    #                'roleid': '5615fa9ae596154a5c000000',
+    #                'roomid': '561b1e59c90a9c0e00df610b',
+    #                'skippedCount': 0,
+    #                'songsInQueue': 31,
+    #                'updated': 1518783663567,
+    #                'userid': '5628edc08d7d6a5600335d3d',
+    #                'waitLine': 0}}
+
+    # OR
+
+    # {'type': 'user-pause-queue',
+    #  'user': {'__v': 0,
+    #           '_id': '560b135c7ae1ea0300869b20',
+    #           'created': 1443566427591,
+    #           'dubs': 0,
+    #           'profileImage': {'bytes': 444903,
+    #                            'etag': '09da0f0c34e6ddf6eb75516ea66e17bc',
+    #                            'format': 'gif',
+    #                            'height': 245,
+    #                            'overwritten': True,
+    #                            'pages': 22,
+    #                            'public_id': 'user/560b135c7ae1ea0300869b20',
+    #                            'resource_type': 'image',
+    #                            'secure_url':
+    # 'https://res.cloudinary.com/hhberclba/image/upload/v1486657178/user/560b135c7ae1ea0300869b20.gif',
+    #                            'tags': [],
+    #                            'type': 'upload',
+    #                            'url':
+    # 'http://res.cloudinary.com/hhberclba/image/upload/v1486657178/user/560b135c7ae1ea0300869b20.gif',
+    #                            'version': 1486657178,
+    #                            'width': 245},
+    #           'roleid': 1,
+    #           'status': 1,
+    #           'username': 'txomon'},
+    #  'user_queue': {'__v': 0,
+    #                 '_id': '5628db0a3883a45600b7e68f',
+    #                 '_user': '560b135c7ae1ea0300869b20',
+    #                 'active': True,
+    #                 'authorized': True,
+    #                 'dubs': 376,
+    #                 'order': 99999,
+    #                 'ot_token': None,
+    #                 'playedCount': 1680,
+    #                 'queuePaused': None,
+    #                 'roleid': '52d1ce33c38a06510c000001',
+    #                 'roomid': '561b1e59c90a9c0e00df610b',
+    #                 'skippedCount': 0,
+    #                 'songsInQueue': 0,
+    #                 'updated': 1519080836290,
+    #                 'userid': '560b135c7ae1ea0300869b20',
+    #                 'waitLine': 0}}
+
+    # TODO: Correct for both posibilities
+    username = content['user']['username']
+    userid = content['user'].get('userInfo', {}).get('userid')
+    userid = userid or content['user']['_id']
+
+    return f'User {username}#{userid} stopped playlist'
+
+
+def describe_user_setrole(content):
+    # {'modUser': {'__v': 0,
+    #              '_id': '560b135c7ae1ea0300869b20',
+    #              'created': 1443566427591,
+    #              'dubs': 0,
+    #              'profileImage': {'bytes': 444903,
+    #                               'etag': '09da0f0c34e6ddf6eb75516ea66e17bc',
+    #                               'format': 'gif',
+    #                               'height': 245,
+    #                               'overwritten': True,
+    #                               'pages': 22,
+    #                               'public_id': 'user/560b135c7ae1ea0300869b20',
+    #                               'resource_type': 'image',
+    #                               'secure_url':
+    # 'https://res.cloudinary.com/hhberclba/image/upload/v1486657178/user/560b135c7ae1ea0300869b20.gif',
+    #                               'tags': [],
+    #                               'type': 'upload',
+    #                               'url':
+    # 'http://res.cloudinary.com/hhberclba/image/upload/v1486657178/user/560b135c7ae1ea0300869b20.gif',
+    #                               'version': 1486657178,
+    #                               'width': 245},
+    #              'roleid': 1,
+    #              'status': 1,
+    #              'username': 'txomon'},
+    #  'role_object': {'__v': 0,
+    #                  '_id': '52d1ce33c38a06510c000001',
+    #                  'label': 'Moderator',
+    #                  'rights': ['skip',
+    #                             'queue-order',
+    #                             'kick',
+    #                             'ban',
+    #                             'mute',
+    #                             'set-dj',
+    #                             'lock-queue',
+    #                             'delete-chat',
+    #                             'chat-mention'],
+    #                  'type': 'mod'},
+    #  'type': 'user-setrole',
+    #  'user': {'__v': 0,
+    #           '_force_updated': 1499443841892,
+    #           '_id': '5628edc08d7d6a5600335d3d',
+    #           'created': 1445522880666,
+    #           'dubs': 0,
+    #           'roleid': 1,
+    #           'status': 1,
+    #           'userInfo': {'__v': 0,
+    #                        '_id': '5628edc08d7d6a5600335d3e',
+    #                        'userid': '5628edc08d7d6a5600335d3d'},
+    #           'username': 'iCel'}}
+    modname = content['modUser']['username']
+    modid = content['modUser']['_id']
+    role = content['role_object']['label']
+    roletype = content['role_object']['type']
+    rights = content['role_object']['rights']
+    username = content['user']['username']
+    userid = content['user']['userInfo']['userid']
+    return (
+        f'User {modname}#{modid} moved to role {role}/{roletype}({", ".join(rights)}) by {username}#'
+        f'{userid}')
+
+
+def describe_user_unsetrole(content):
+    # {'modUser': {'__v': 0,
+    #              '_id': '560b135c7ae1ea0300869b20',
+    #              'created': 1443566427591,
+    #              'dubs': 0,
+    #              'profileImage': {'bytes': 444903,
+    #                               'etag': '09da0f0c34e6ddf6eb75516ea66e17bc',
+    #                               'format': 'gif',
+    #                               'height': 245,
+    #                               'overwritten': True,
+    #                               'pages': 22,
+    #                               'public_id': 'user/560b135c7ae1ea0300869b20',
+    #                               'resource_type': 'image',
+    #                               'secure_url':
+    # 'https://res.cloudinary.com/hhberclba/image/upload/v1486657178/user/560b135c7ae1ea0300869b20.gif',
+    #                               'tags': [],
+    #                               'type': 'upload',
+    #                               'url':
+    # 'http://res.cloudinary.com/hhberclba/image/upload/v1486657178/user/560b135c7ae1ea0300869b20.gif',
+    #                               'version': 1486657178,
+    #                               'width': 245},
+    #              'roleid': 1,
+    #              'status': 1,
+    #              'username': 'txomon'},
+    #  'role_object': {'__v': 0,
+    #                  '_id': '52d1ce33c38a06510c000001',
+    #                  'label': 'Moderator',
+    #                  'rights': ['skip',
+    #                             'queue-order',
+    #                             'kick',
+    #                             'ban',
+    #                             'mute',
+    #                             'set-dj',
+    #                             'lock-queue',
+    #                             'delete-chat',
+    #                             'chat-mention'],
+    #                  'type': 'mod'},
+    #  'type': 'user-unsetrole',
+    #  'user': {'__v': 0,
+    #           '_force_updated': 1499443841892,
+    #           '_id': '5628edc08d7d6a5600335d3d',
+    #           'created': 1445522880666,
+    #           'dubs': 0,
+    #           'roleid': 1,
+    #           'status': 1,
+    #           'userInfo': {'__v': 0,
+    #                        '_id': '5628edc08d7d6a5600335d3e',
+    #                        'userid': '5628edc08d7d6a5600335d3d'},
+    #           'username': 'iCel'}}
+    modname = content['modUser']['username']
+    modid = content['modUser']['_id']
+    role = content['role_object']['label']
+    roletype = content['role_object']['type']
+    rights = content['role_object']['rights']
+    username = content['user']['username']
+    userid = content['user']['userInfo']['userid']
+    return (
+        f'User {modname}#{modid} removed from role {role}/{roletype}({", ".join(rights)}) by {username}#'
+        f'{userid}')
+
+
+def describe_user_update(content):
+    # {'type': 'user_update_56096ce7a98a6b0300144e33',
+    #  'user': {'_id': '5628b1c7e884391300d7427c',
+    #           'updated': 1518781252893,
+    #           'skippedCount': 0,
+    #           'playedCount': 39994,
+    #           'songsInQueue': 386,
+    #           'active': True,
+    #           'dubs': 15316,
+    #           'order': 99999,
+    #           'roomid': '561b1e59c90a9c0e00df610b',
+    #           'userid': '56096ce7a98a6b0300144e33',
+    #           '_user': '56096ce7a98a6b0300144e33',
+    #           '__v': 0,
+    #           'ot_token': None,
+    #           'roleid': '5615fd84e596150061000003',
+    #           'queuePaused': None,
+    #           'authorized': True,
+    #           'waitLine': 0}}
+    user = content['user']
+    userid = user['userid']
+    skipped_count = user['skippedCount']
+    played_count = user['playedCount']
+    songs_in_queue = user['songsInQueue']
+    dubs = user['dubs']
+    return (
+        f'User updated {userid}, skip {skipped_count}, played {played_count}, queue {songs_in_queue}, '
+        f'dubs {dubs}')
+
+
+# Describe room events for debug logs, keyed by the room message name
+CONTENT_DESCRIBERS = {
+    'chat-message': describe_chat_message,
+    'chat-skip': describe_chat_skip,
+    'delete-chat-message': describe_delete_chat_message,
+    'room_playlist-dub': describe_room_playlist_dub,
+    'room_playlist-queue-reorder': describe_room_playlist_queue_reorder,
+    'room_playlist-queue-update-dub': describe_room_playlist_queue_update_dub,
+    'room_playlist-update': describe_room_playlist_update,
+    'user-join': describe_user_join,
+    'user-pause-queue': describe_user_pause_queue,
+    'user-setrole': describe_user_setrole,
+    'user-unsetrole': describe_user_unsetrole,
+}
+CONTENT_DESCRIBER_PREFIXES = {
+    'user_update': describe_user_update,
+}
+
+
+def get_content_describer(content_type):
+    describer = CONTENT_DESCRIBERS.get(content_type)
+    if describer is None:
+        for prefix, prefix_describer in CONTENT_DESCRIBER_PREFIXES.items():
+            if content_type.startswith(prefix):
+                return prefix_describer
+    return describer
+
+
+class DubtrackFrameDecoder:
+    """
+    Decode frames received through the Dubtrack websocket
+
+    Frames are a digit code followed by JSON for data frames: 4{"action": 15, ...}. Data frames are dispatched on
+    their action, and room messages (action 15) carry the event as JSON text, which is what `decode` returns.
+    Any other frame only updates the connection state of the websocket, and `decode` returns None.
+    """
+
+    def __init__(self, dubtrackws: 'DubtrackWS'):
+        self.dubtrackws = dubtrackws
+        self.action_handlers = {
+            4: self.handle_client_id,
+            11: self.handle_subscription_ack,
+            14: self.handle_presence,
+            15: self.handle_room_message,
+        }
+
+    def decode(self, frame: str) -> Optional[dict]:
+        code = frame[:1]
+        if code != DubtrackWS.DATA:
+            self.handle_control(code, frame)
+            return None
+        if logger_layer1.isEnabledFor(logging.DEBUG):
+            logger_layer1.debug(f'Received message: {frame}')
+        data = json_codec.loads(frame[1:])
+        handler = self.action_handlers.get(data['action'])
+        if handler is None:
+            logger_layer2.warning(f'Received unknown action {data["action"]}')
+            return None
+        return handler(data)
+
+    def handle_control(self, code, frame):
+        if code == DubtrackWS.PONG:
+            logger_layer1.debug('Received pong')
+        elif code == DubtrackWS.PING:
+            logger_layer1.warning('Received a ping?!?')
+        elif code != DubtrackWS.INIT:  # Ignoring the heartbeat rate for now
+            logger_layer1.warning(f'Received unknown message {frame}')
+
+    def handle_client_id(self, data):
+        # Client ID given for future reconnections
+        self.dubtrackws.ws_client_id = data['clientId']
+        self.dubtrackws.connection_id = data['connectionId']
+
+    def handle_subscription_ack(self, data):
+        # ACK from action=10, also contains what in #4
+        pass
+
+    def handle_presence(self, data):
+        presence = data['presence']
+        connection_id = presence.get('connectionId')
+        client_id = presence.get('clientId')
+        if 'reqId' in data and connection_id != self.dubtrackws.connection_id:
+            logger_layer2.error(
+                f'Presence packet says connectionId {connection_id} instead of {self.dubtrackws.connection_id}. '
+                f'Ignoring..?')
+            return
+        if presence['action'] == 0:
+            logger_layer2.debug(f'Client {client_id} connected with {connection_id}')
+            self.dubtrackws.connected_clients[client_id].add(connection_id)
+        elif presence['action'] == 1:
+            logger_layer2.debug(f'Client {client_id} disconnected with {connection_id}')
+            self.dubtrackws.connected_clients[client_id].discard(connection_id)
+
+    def handle_room_message(self, data):
+        message = data['message']
+        if message['type'] != 'json':
+            logger_layer3.info(f'Ignoring, becase type is not json: {message}')
+            return None
+
+        content_type = message['name']
+        content = json_codec.loads(message['data'])
+        if content_type == 'chat-message':
+            suppress_messages = self.dubtrackws.suppress_messages
+            msg = content['message']
+            if msg in suppress_messages:
+                suppress_messages.remove(msg)
+                logger_layer3.debug(f'Suppressing message: {msg}')
+                return None
+        self.log_content(content_type, content)
+        return content
+
+    def log_content(self, content_type, content):
+        describer = get_content_describer(content_type)
+        if describer is None:
+            if logger_layer3.isEnabledFor(logging.INFO):
+                logger_layer3.info(f'Received unknown message {content_type}: {pprint.pformat(content)}')
+        elif logger_layer3.isEnabledFor(logging.DEBUG):
+            try:
+                logger_layer3.debug(describer(content))
+            except (KeyError, TypeError):
+                logger_layer3.debug(f'Received unexpected {content_type} message: {content}')
+
+
 class DubtrackWS:
     INIT = '0'
     PING = '2'
     PONG = '3'
     DATA = '4'
 
+    # Characters of each request/response payload to log when tracing
+    TRACE_PAYLOAD_LIMIT = 2000
+
     def __init__(self, room):
         self.room = room
         self.heartbeat = None
@@ -591,39 +1295,53 @@ class DubtrackWS:
         self.connection_id = None
         self.connected_clients = defaultdict(set)
         self.aio_session = None
+        self.transport = None
         self.user_session_info = None
         self.room_user_info = None
         self.room_info = None
         self.userpass = None
         self.suppress_messages = list()
         self.logged_in = None
+        self.frame_decoder = DubtrackFrameDecoder(self)
 
     async def initialize(self):
-        self.aio_session = aiohttp.ClientSession()
+        if self.transport:
+            self.aio_session = self.transport.session(json_serialize=json_codec.dumps)
+        else:
+            self.aio_session = aiohttp.ClientSession(json_serialize=json_codec.dumps)
         # POST https://api.dubtrack.fm/auth/dubtrack
         if self.userpass:
             self.logged_in = await self.login(*self.userpass)
         # GET https://api.dubtrack.fm/auth/session
         await self.get_user_session_info()
 
+    async def close(self):
+        if self.aio_session and not self.aio_session.closed:
+            await self.aio_session.close()
+
     def set_login(self, username, password):
         if any((self.user_session_info, self.room_user_info, self.room_info)):
             raise ValueError('Once started, cannot login')
         self.userpass = (username, password)
 
-    async def api_post(self, url, body):
-        async with self.aio_session.post(url, json=body) as resp:
-            logger.debug(f'Request: {url} - {body}')
-            response = await resp.json()
-            logger.debug(f'Response: {pprint.pformat(response)}')
+    async def api_request(self, method, url, body=None):
+        async with self.aio_session.request(method, url, json=body) as resp:
+            response = await resp.json(loads=json_codec.loads)
+            status = resp.status
+        if logger_http.isEnabledFor(logging.DEBUG):
+            limit = self.TRACE_PAYLOAD_LIMIT
+            logger_http.debug('%s %s - %s => %s %s', method, url, TracePayload(body, limit), status,
+                              TracePayload(response, limit))
         return response['data']
 
+    async def api_post(self, url, body):
+        return await self.api_request('POST', url, body)
+
     async def api_get(self, url):
-        async with self.aio_session.get(url) as resp:
-            logger.debug(f'Request: {url}')
-            response = await resp.json()
-            logger.debug(f'Response: {pprint.pformat(response)}')
-        return response['data']
+        return await self.api_request('GET', url)
+
+    async def api_delete(self, url):
+        return await self.api_request('DELETE', url)
 
     async def get_user_session_info(self):
         # {"userInfo": {"_id": "560b135c7ae1ea0300869b21",
@@ -1243,12 +1961,7 @@ class DubtrackWS:
         # {"userNextSong": None}
 
         room_id = await self.get_room_id()
-        url = f'https://api.dubtrack.fm/room/{room_id}/queue/user/{user_id}'
-        async with self.aio_session.delete(url) as resp:
-            logger.debug(f'Request: {url}')
-            response = await resp.json()
-            logger.debug(f'Response: {pprint.pformat(response)}')
-        return response['data']
+        return await self.api_delete(f'https://api.dubtrack.fm/room/{room_id}/queue/user/{user_id}')
 
     async def raw_ws_consume(self):
         last_token_fail = last_consume_fail = 0
@@ -1320,7 +2033,7 @@ class DubtrackWS:
             'action': 10,
             "channel": f'room:{room_id}',
         }
-        await self.ws_send(f'4{json.dumps(subscription)}')
+        await self.ws_send(f'4{json_codec.dumps(subscription)}')
 
     async def send_presence_update(self):
         room_id = await self.get_room_id()
@@ -1329,7 +2042,7 @@ class DubtrackWS:
             "channel": f'room:{room_id}',
             "presence": {"action": 0, "data": {}},
             "reqId": gen_request_id()}
-        await self.ws_send(f'4{json.dumps(presence_update)}')
+        await self.ws_send(f'4{json_codec.dumps(presence_update)}')
 
     async def ws_session_opened_cb(self):
         if not self.heartbeat:
@@ -1339,493 +2052,7 @@ class DubtrackWS:
         await self.send_presence_update()
 
     async def ws_api_consume(self):
-        async for session, message in self.raw_ws_consume():
-            # First layer
-            # They have a digit+json... => 1{"asdf": "czxc"}
-            code = message[0]
-            if code == self.INIT:
-                continue  # Ignoring the heartbeat rate for now
-            elif code == self.PING:
-                logger_layer1.warning('Received a ping?!?')
-                continue
-            elif code == self.PONG:
-                logger_layer1.debug('Received pong')
-                continue
-            elif code != '4':  # 4 is the main case
-                logger_layer1.warning('Received unknown message {message}')
-                continue
-
-            logger_layer1.debug(f'Received message: {message}')
-
-            # Second layer: 4
-            # They have action in the first level of the json
-            data = json.loads(message[1:])
-            action = data['action']
-            if action == 4:  # Client ID given for future reconnections
-                self.ws_client_id = data['clientId']
-                self.connection_id = data['connectionId']
-                continue
-            elif action == 11:  # ACK from action=10, also contains what in #4
-                continue
-            elif action == 14:  # Presence updates
-                presence = data['presence']
-                connection_id = presence.get('connectionId')
-                client_id = presence.get('clientId')
-                if 'reqId' in data and connection_id != self.connection_id:
-                    logger_layer2.error(
-                        f'Presence packet says connectionId {connection_id} instead of {self.connection_id}. '
-                        f'Ignoring..?')
-                    continue
-                if action == 0:
-                    logger_layer2.debug(
-                        f'Client {client_id} connected with {connection_id}')
-                    self.connected_clients[client_id].add(connection_id)
-                elif action == 1:
-                    logger_layer2.debug(
-                        f'Client {client_id} disconnected with {connection_id}')
-                    self.connected_clients[client_id].remove(connection_id)
-                continue
-            elif action != 15:  # 4, Action 15 is the main case
-                logger_layer2.warning('Received unknown action {action}')
-                continue
-
-            # Third layer: 4=>action#15
-            message = data['message']
-            if message['type'] != 'json':
-                logger_layer3.info(
-                    f'Ignoring, becase type is not json: {message}')
-                continue
-
-            content_type = message['name']
-            content = json.loads(message['data'])
-            if content_type == 'chat-message':
-                # {'chatid': '560b135c7ae1ea0300869b20-1518783003490',
-                #  'message': 'this is going goood :P',
-                #  'queue_object': {'__v': 0,
-                #                   '_id': '5628db0a3883a45600b7e68f',
-                #                   '_user': '560b135c7ae1ea0300869b20',
-                #                   'active': True,
-                #                   'authorized': True,
-                #                   'dubs': 368,
-                #                   'order': 99999,
-                #                   'ot_token': None,
-                #                   'playedCount': 1677,
-                #                   'queuePaused': None,
-                #                   'roleid': '52d1ce33c38a06510c000001',
-                #                   'roomid': '561b1e59c90a9c0e00df610b',
-                #                   'skippedCount': 0,
-                #                   'songsInQueue': 0,
-                #                   'updated': 1518771989676,
-                #                   'userid': '560b135c7ae1ea0300869b20',
-                #                   'waitLine': 0},
-                #  'time': 1518783003490,
-                #  'type': 'chat-message',
-                #  'user': {'__v': 0,
-                #           '_force_updated': 1516971162191,
-                #           '_id': '560b135c7ae1ea0300869b20',
-                #           'created': 1443566427591,
-                #           'dubs': 0,
-                #           'roleid': 1,
-                #           'status': 1,
-                #           'userInfo': {'__v': 0,
-                #                        '_id': '560b135c7ae1ea0300869b21',
-                #                        'userid': '560b135c7ae1ea0300869b20'},
-                #           'username': 'txomon'}}
-                chatid = content['chatid']
-                username = content['user']['username']
-                userid = content['user']['userInfo']['userid']
-                msg = content["message"]
-                logger_layer3.debug(
-                    f'Chat {username}#{userid} (chatid#{chatid}): {msg}')
-                if msg in self.suppress_messages:
-                    self.suppress_messages.remove(msg)
-                    logger_layer3.debug(f'Suppressing message: {msg}')
-                    continue
-            elif content_type == 'chat-skip':
-                # {'type': 'chat-skip', 'username': 'txomon'}
-                username = content['username']
-                logger_layer3.debug(f'Chat-skip by {username}')
-            elif content_type == 'delete-chat-message':
-                # {'chatid': '560b135c7ae1ea0300869b20-1518784684020',
-                #  'type': 'delete-chat-message',
-                #  'user': {'__v': 0,
-                #           '_force_updated': 1516971162191,
-                #           '_id': '560b135c7ae1ea0300869b20',
-                #           'created': 1443566427591,
-                #           'dubs': 0,
-                #           'roleid': 1,
-                #           'status': 1,
-                #           'userInfo': {'__v': 0,
-                #                        '_id': '560b135c7ae1ea0300869b21',
-                #                        'userid': '560b135c7ae1ea0300869b20'},
-                #           'username': 'txomon'}}
-                username = content['user']['username']
-                userid = content['user']['userInfo']['userid']
-                chatid = content['chatid']
-                logger_layer3.debug(f'User {username}#{userid} deleted {chatid}')
-            elif content_type == 'room_playlist-dub':
-                # {'dubtype': 'downdub',
-                #  'playlist': {'__v': 0,
-                #               '_id': '5a8453cad51c3101003df01c',
-                #               '_song': '5a0db972fd20620100678621',
-                #               '_user': '56a80c626894b9410067b716',
-                #               'created': 1518621640481,
-                #               'downdubs': 1,
-                #               'isActive': True,
-                #               'isPlayed': False,
-                #               'order': 2,
-                #               'played': 1518782587986,
-                #               'roomid': '561b1e59c90a9c0e00df610b',
-                #               'skipped': False,
-                #               'songLength': 221000,
-                #               'songid': '5a0db972fd20620100678621',
-                #               'updubs': 0,
-                #               'userid': '56a80c626894b9410067b716'},
-                #  'type': 'room_playlist-dub',
-                #  'user': {'__v': 0,
-                #           '_force_updated': 1516971162191,
-                #           '_id': '560b135c7ae1ea0300869b20',
-                #           'created': 1443566427591,
-                #           'dubs': 0,
-                #           'roleid': 1,
-                #           'status': 1,
-                #           'userInfo': {'__v': 0,
-                #                        '_id': '560b135c7ae1ea0300869b21',
-                #                        'userid': '560b135c7ae1ea0300869b20'},
-                #           'username': 'txomon'}}
-                dubtype = content['dubtype']
-                username = content['user']['username']
-                userid = content['user']['userInfo']['userid']
-                downdubs = content['playlist']['downdubs']
-                updubs = content['playlist']['updubs']
-                logger_layer3.debug(
-                    f"Song {dubtype} by {username}#{userid}, total {updubs}U/{downdubs}D")
-            elif content_type == 'room_playlist-queue-reorder':
-                # {'type': 'room_playlist-queue-reorder',
-                #  'user': {'__v': 0,
-                #           '_force_updated': 1516971162191,
-                #           '_id': '560b135c7ae1ea0300869b20',
-                #           'created': 1443566427591,
-                #           'dubs': 0,
-                #           'roleid': 1,
-                #           'status': 1,
-                #           'userInfo': {'__v': 0,
-                #                        '_id': '560b135c7ae1ea0300869b21',
-                #                        'userid': '560b135c7ae1ea0300869b20'},
-                #           'username': 'txomon'}}
-                username = content['user']['username']
-                userid = content['user']['userInfo']['userid']
-                logger_layer3.debug(
-                    f'User {username}#{userid} reordered the queue')
-            elif content_type == 'room_playlist-queue-update-dub':
-                # {'type': 'room_playlist-queue-update-dub',
-                #  'user': {'__v': 0,
-                #           '_force_updated': 1499443841892,
-                #           '_id': '5628edc08d7d6a5600335d3d',
-                #           'created': 1445522880666,
-                #           'dubs': 0,
-                #           'roleid': 1,
-                #           'status': 1,
-                #           'userInfo': {'__v': 0,
-                #                        '_id': '5628edc08d7d6a5600335d3e',
-                #                        'userid': '5628edc08d7d6a5600335d3d'},
-                #           'username': 'iCel'}}
-                username = content['user']['username']
-                userid = content['user']['userInfo']['userid']
-                logger_layer3.debug(
-                    f'User {username}/{userid} changed personal queue')
-            elif content_type == 'room_playlist-update':
-                # {'startTime': -1,
-                #  'song': {'_id': '5a853a0a07f061010053d3c8',
-                #           'created': 1518680579959,
-                #           'isActive': True,
-                #           'isPlayed': False,
-                #           'skipped': False,
-                #           'order': 109,
-                #           'roomid': '561b1e59c90a9c0e00df610b',
-                #           'songLength': 194000,
-                #           'updubs': 0, 'downdubs': 0,
-                #           'userid': '56096ce7a98a6b0300144e33',
-                #           'songid': '584efe5534194d8400cfd013',
-                #           '_user': '56096ce7a98a6b0300144e33',
-                #           '_song': '584efe5534194d8400cfd013',
-                #           '__v': 0,
-                #           'played': 1518781826209},
-                #  'songInfo': {'_id': '584efe5534194d8400cfd013',
-                #               'name': 'Luis Alvarez - Final Time',
-                #               'images': {'thumbnail': 'https://i.ytimg.com/vi/KHkPbbdu5kk/hqdefault.jpg'},
-                #               'type': 'youtube',
-                #               'songLength': 194000,
-                #               'fkid': 'KHkPbbdu5kk',
-                #               '__v': 0,
-                #               'created': '2016-12-12T19:45:25.669Z'},
-                #  'type': 'room_playlist-update'}
-                songinfo = content['songInfo']
-                name = songinfo['name']
-                songtype = songinfo['type']
-                songid = songinfo['fkid']
-                logger_layer3.debug(f'Now playing {songtype}#{songid}: {name}')
-            elif content_type == 'user-join':
-                # {'roomUser': {'__v': 0,
-                #               '_id': '57f36aff34169c1a0018f92d',
-                #               '_user': '57f36acd6c9b5c5b003d41d2',
-                #               'active': False,
-                #               'authorized': True,
-                #               'dubs': 3533,
-                #               'order': 99999,
-                #               'ot_token': None,
-                #               'playedCount': 10862,
-                #               'queuePaused': None,
-                #               'roomid': '561b1e59c90a9c0e00df610b',
-                #               'skippedCount': 0,
-                #               'songsInQueue': 588,
-                #               'updated': 1518783589638,
-                #               'userid': '57f36acd6c9b5c5b003d41d2',
-                #               'waitLine': 0},
-                #  'type': 'user-join',
-                #  'user': {'__v': 0,
-                #           '_force_updated': 1504509671098,
-                #           '_id': '57f36acd6c9b5c5b003d41d2',
-                #           'created': 1475570381585,
-                #           'dubs': 0,
-                #           'roleid': 1,
-                #           'status': 1,
-                #           'userInfo': {'__v': 0,
-                #                        '_id': '57f36acd6c9b5c5b003d41d3',
-                #                        'userid': '57f36acd6c9b5c5b003d41d2'},
-                #           'username': 'eberg'}}
-                username = content['user']['username']
-                userid = content['user']['userInfo']['userid']
-                # TODO: Explore roomUser
-                logger_layer3.debug(f'User {username}#{userid} joined')
-            elif content_type == 'user-pause-queue':
-                # {'type': 'user-pause-queue',
-                #  'user': {'__v': 0,
-                #           '_force_updated': 1499443841892,
-                #           '_id': '5628edc08d7d6a5600335d3d',
-                #           'created': 1445522880666,
-                #           'dubs': 0,
-                #           'roleid': 1,
-                #           'status': 1,
-                #           'userInfo': {'__v': 0,
-                #                        '_id': '5628edc08d7d6a5600335d3e',
-                #                        'userid': '5628edc08d7d6a5600335d3d'},
-                #           'username': 'iCel'},
-                # 'user_queue': {'__v': 0,
-                #                '_id': '5628ededa2d0f81300edc39a',
-                #                '_user': '5628edc08d7d6a5600335d3d',
-                #                'active': True,
-                #                'authorized': True,
-                #                'dubs': 25899,
-                #                'order': 99999,
-                #                'ot_token': None,
-                #                'playedCount': 23897,
-                #                'queuePaused': None,
-                #                'roleid': '5615fa9ae596154a5c000000',
-                #                'roomid': '561b1e59c90a9c0e00df610b',
-                #                'skippedCount': 0,
-                #                'songsInQueue': 31,
-                #                'updated': 1518783663567,
-                #                'userid': '5628edc08d7d6a5600335d3d',
-                #                'waitLine': 0}}
-
-                # OR
-
-                # {'type': 'user-pause-queue',
-                #  'user': {'__v': 0,
-                #           '_id': '560b135c7ae1ea0300869b20',
-                #           'created': 1443566427591,
-                #           'dubs': 0,
-                #           'profileImage': {'bytes': 444903,
-                #                            'etag': '09da0f0c34e6ddf6eb75516ea66e17bc',
-                #                            'format': 'gif',
-                #                            'height': 245,
-                #                            'overwritten': True,
-                #                            'pages': 22,
-                #                            'public_id': 'user/560b135c7ae1ea0300869b20',
-                #                            'resource_type': 'image',
-                #                            'secure_url':
-                # 'https://res.cloudinary.com/hhberclba/image/upload/v1486657178/user/560b135c7ae1ea0300869b20.gif',
-                #                            'tags': [],
-                #                            'type': 'upload',
-                #                            'url':
-                # 'http://res.cloudinary.com/hhberclba/image/upload/v1486657178/user/560b135c7ae1ea0300869b20.gif',
-                #                            'version': 1486657178,
-                #                            'width': 245},
-                #           'roleid': 1,
-                #           'status': 1,
-                #           'username': 'txomon'},
-                #  'user_queue': {'__v': 0,
-                #                 '_id': '5628db0a3883a45600b7e68f',
-                #                 '_user': '560b135c7ae1ea0300869b20',
-                #                 'active': True,
-                #                 'authorized': True,
-                #                 'dubs': 376,
-                #                 'order': 99999,
-                #                 'ot_token': None,
-                #                 'playedCount': 1680,
-                #                 'queuePaused': None,
-                #                 'roleid': '52d1ce33c38a06510c000001',
-                #                 'roomid': '561b1e59c90a9c0e00df610b',
-                #                 'skippedCount': 0,
-                #                 'songsInQueue': 0,
-                #                 'updated': 1519080836290,
-                #                 'userid': '560b135c7ae1ea0300869b20',
-                #                 'waitLine': 0}}
-
-                # TODO: Correct for both posibilities
-                username = content['user']['username']
-                userid = content['user'].get('userInfo', {}).get('userid')
-                userid = userid or content['user']['_id']
-
-                logger_layer3.debug(f'User {username}#{userid} stopped playlist')
-            elif content_type == 'user-setrole':
-                # {'modUser': {'__v': 0,
-                #              '_id': '560b135c7ae1ea0300869b20',
-                #              'created': 1443566427591,
-                #              'dubs': 0,
-                #              'profileImage': {'bytes': 444903,
-                #                               'etag': '09da0f0c34e6ddf6eb75516ea66e17bc',
-                #                               'format': 'gif',
-                #                               'height': 245,
-                #                               'overwritten': True,
-                #                               'pages': 22,
-                #                               'public_id': 'user/560b135c7ae1ea0300869b20',
-                #                               'resource_type': 'image',
-                #                               'secure_url':
-                # 'https://res.cloudinary.com/hhberclba/image/upload/v1486657178/user/560b135c7ae1ea0300869b20.gif',
-                #                               'tags': [],
-                #                               'type': 'upload',
-                #                               'url':
-                # 'http://res.cloudinary.com/hhberclba/image/upload/v1486657178/user/560b135c7ae1ea0300869b20.gif',
-                #                               'version': 1486657178,
-                #                               'width': 245},
-                #              'roleid': 1,
-                #              'status': 1,
-                #              'username': 'txomon'},
-                #  'role_object': {'__v': 0,
-                #                  '_id': '52d1ce33c38a06510c000001',
-                #                  'label': 'Moderator',
-                #                  'rights': ['skip',
-                #                             'queue-order',
-                #                             'kick',
-                #                             'ban',
-                #                             'mute',
-                #                             'set-dj',
-                #                             'lock-queue',
-                #                             'delete-chat',
-                #                             'chat-mention'],
-                #                  'type': 'mod'},
-                #  'type': 'user-setrole',
-                #  'user': {'__v': 0,
-                #           '_force_updated': 1499443841892,
-                #           '_id': '5628edc08d7d6a5600335d3d',
-                #           'created': 1445522880666,
-                #           'dubs': 0,
-                #           'roleid': 1,
-                #           'status': 1,
-                #           'userInfo': {'__v': 0,
-                #                        '_id': '5628edc08d7d6a5600335d3e',
-                #                        'userid': '5628edc08d7d6a5600335d3d'},
-                #           'username': 'iCel'}}
-                modname = content['modUser']['username']
-                modid = content['modUser']['_id']
-                role = content['role_object']['label']
-                roletype = content['role_object']['type']
-                rights = content['role_object']['rights']
-                username = content['user']['username']
-                userid = content['user']['userInfo']['userid']
-                logger_layer3.debug(
-                    f'User {modname}#{modid} moved to role {role}/{roletype}({", ".join(rights)}) by {username}#'
-                    f'{userid}')
-            elif content_type == 'user-unsetrole':
-                # {'modUser': {'__v': 0,
-                #              '_id': '560b135c7ae1ea0300869b20',
-                #              'created': 1443566427591,
-                #              'dubs': 0,
-                #              'profileImage': {'bytes': 444903,
-                #                               'etag': '09da0f0c34e6ddf6eb75516ea66e17bc',
-                #                               'format': 'gif',
-                #                               'height': 245,
-                #                               'overwritten': True,
-                #                               'pages': 22,
-                #                               'public_id': 'user/560b135c7ae1ea0300869b20',
-                #                               'resource_type': 'image',
-                #                               'secure_url':
-                # 'https://res.cloudinary.com/hhberclba/image/upload/v1486657178/user/560b135c7ae1ea0300869b20.gif',
-                #                               'tags': [],
-                #                               'type': 'upload',
-                #                               'url':
-                # 'http://res.cloudinary.com/hhberclba/image/upload/v1486657178/user/560b135c7ae1ea0300869b20.gif',
-                #                               'version': 1486657178,
-                #                               'width': 245},
-                #              'roleid': 1,
-                #              'status': 1,
-                #              'username': 'txomon'},
-                #  'role_object': {'__v': 0,
-                #                  '_id': '52d1ce33c38a06510c000001',
-                #                  'label': 'Moderator',
-                #                  'rights': ['skip',
-                #                             'queue-order',
-                #                             'kick',
-                #                             'ban',
-                #                             'mute',
-                #                             'set-dj',
-                #                             'lock-queue',
-                #                             'delete-chat',
-                #                             'chat-mention'],
-                #                  'type': 'mod'},
-                #  'type': 'user-unsetrole',
-                #  'user': {'__v': 0,
-                #           '_force_updated': 1499443841892,
-                #           '_id': '5628edc08d7d6a5600335d3d',
-                #           'created': 1445522880666,
-                #           'dubs': 0,
-                #           'roleid': 1,
-                #           'status': 1,
-                #           'userInfo': {'__v': 0,
-                #                        '_id': '5628edc08d7d6a5600335d3e',
-                #                        'userid': '5628edc08d7d6a5600335d3d'},
-                #           'username': 'iCel'}}
-                modname = content['modUser']['username']
-                modid = content['modUser']['_id']
-                role = content['role_object']['label']
-                roletype = content['role_object']['type']
-                rights = content['role_object']['rights']
-                username = content['user']['username']
-                userid = content['user']['userInfo']['userid']
-                logger_layer3.debug(
-                    f'User {modname}#{modid} removed from role {role}/{roletype}({", ".join(rights)}) by {username}#'
-                    f'{userid}')
-            elif content_type.startswith('user_update'):
-                # {'type': 'user_update_56096ce7a98a6b0300144e33',
-                #  'user': {'_id': '5628b1c7e884391300d7427c',
-                #           'updated': 1518781252893,
-                #           'skippedCount': 0,
-                #           'playedCount': 39994,
-                #           'songsInQueue': 386,
-                #           'active': True,
-                #           'dubs': 15316,
-                #           'order': 99999,
-                #           'roomid': '561b1e59c90a9c0e00df610b',
-                #           'userid': '56096ce7a98a6b0300144e33',
-                #           '_user': '56096ce7a98a6b0300144e33',
-                #           '__v': 0,
-                #           'ot_token': None,
-                #           'roleid': '5615fd84e596150061000003',
-                #           'queuePaused': None,
-                #           'authorized': True,
-                #           'waitLine': 0}}
-                user = content['user']
-                userid = user['userid']
-                skipped_count = user['skippedCount']
-                played_count = user['playedCount']
-                songs_in_queue = user['songsInQueue']
-                dubs = user['dubs']
-                logger_layer3.debug(
-                    f'User updated {userid}, skip {skipped_count}, played {played_count}, queue {songs_in_queue}, '
-                    f'dubs {dubs}')
-            else:
-                logger_layer3.info(
-                    f'Received unknown message {content_type}: {pprint.pformat(content)}')
-            yield content
+        async for session, frame in self.raw_ws_consume():
+            content = self.frame_decoder.decode(frame)
+            if content is not None:
+                yield content
@@ -2,17 +2,25 @@
 from __future__ import absolute_import, print_function, unicode_literals
 
 import asyncio
-import json
 import logging
-from typing import List, Union
+import random
+import re
+import time
+from collections import defaultdict, deque
+from typing import DefaultDict, Deque, Dict, Hashable, Iterable, Iterator, List, Optional, Set, Tuple, Union
 
 import aiohttp
-from aiohttp import WSMsgType
+from aiohttp import ClientError, WSMsgType
 from aiohttp.formdata import FormData
 from multidict import MultiDict
 
+from abot.util import chunk_text, json_codec, retrieve_exception, TokenBucket
+
 logger = logging.getLogger(__name__)
 
+# Slack sends the type as the first key of RTM events, which allows reading it without decoding the frame
+RTM_FRAME_TYPE = re.compile(r'\s*\{\s*"type"\s*:\s*"([^"]+)"')
+
 
 class SlackException(Exception):
     pass
@@ -28,10 +36,187 @@ class SlackCallException(SlackException):
         return f'Slack call {self.method}. {self.message}'
 
 
+class SlackRateLimitedException(SlackCallException):
+    def __init__(self, message, method, retry_after):
+        self.retry_after = retry_after
+        super().__init__(message, method)
+
+
 class SlackUseException(SlackException):
     pass
 
 
+class SlackAckException(SlackException):
+    pass
+
+
+class SlackEntityStore:
+    """Slack entities (users, channels, ims...) indexed by id and by name.
+
+    Entities are the dicts as received from Slack. They can be modified in
+    place, except for their name, which has to be changed through `update` so
+    that the name index is kept in sync.
+    """
+
+    def __init__(self, entities: Iterable[dict] = ()):
+        self._entities: Dict[str, dict] = {}
+        self._names: Dict[str, Dict[str, dict]] = defaultdict(dict)
+        for entity in entities:
+            self.add(entity)
+
+    def __len__(self):
+        return len(self._entities)
+
+    def __iter__(self) -> Iterator[dict]:
+        return iter(self._entities.values())
+
+    def __contains__(self, entity_id):
+        return entity_id in self._entities
+
+    def get(self, entity_id) -> Optional[dict]:
+        return self._entities.get(entity_id)
+
+    def find_by_name(self, name) -> List[dict]:
+        return list(self._names.get(name, {}).values())
+
+    def add(self, entity: dict) -> dict:
+        entity_id = entity['id']
+        old_entity = self._entities.get(entity_id)
+        if old_entity is not None:
+            self._unindex_name(old_entity)
+        self._entities[entity_id] = entity
+        self._index_name(entity)
+        return entity
+
+    def update(self, entity_id, fields: dict) -> dict:
+        entity = self._entities.get(entity_id)
+        if entity is None:
+            return self.add(dict(fields, id=entity_id))
+        self._unindex_name(entity)
+        entity.update(fields)
+        self._index_name(entity)
+        return entity
+
+    def _index_name(self, entity: dict):
+        name = entity.get('name')
+        if name is not None:
+            self._names[name][entity['id']] = entity
+
+    def _unindex_name(self, entity: dict):
+        name = entity.get('name')
+        if name is None:
+            return
+        entities = self._names.get(name)
+        if entities is not None:
+            entities.pop(entity['id'], None)
+            if not entities:
+                del self._names[name]
+
+
+class SlackAckTracker:
+    """
+    Futures of RTM messages waiting for Slack to acknowledge them
+
+    Each message gets a deadline after which its future fails. At most `window` messages can be waiting for an
+    acknowledgement at the same time, `wait_available` blocks senders until there is room for another one.
+    """
+
+    def __init__(self, timeout=10, window=100):
+        self.timeout = timeout
+        self.window = window
+        self.pending: Dict[int, Tuple[asyncio.Future, float, asyncio.TimerHandle]] = {}
+        self._waiters: Deque[asyncio.Future] = deque()
+        self.acked = 0
+        self.failed = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    @property
+    def outstanding(self):
+        return len(self.pending)
+
+    def metrics(self) -> dict:
+        return {
+            'outstanding': self.outstanding,
+            'acked': self.acked,
+            'failed': self.failed,
+            'latency_mean': self.latency_total / self.acked if self.acked else 0.0,
+            'latency_max': self.latency_max,
+        }
+
+    async def wait_available(self):
+        while len(self.pending) >= self.window:
+            waiter = asyncio.get_event_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+
+    def track(self, message_id) -> asyncio.Future:
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        # Senders are free to ignore acknowledgements
+        future.add_done_callback(retrieve_exception)
+        deadline = loop.call_later(self.timeout, self._expire, message_id)
+        self.pending[message_id] = future, time.monotonic(), deadline
+        return future
+
+    def resolve(self, reply_to, message) -> bool:
+        """Set the result of the message being replied to, returns False if it was not being tracked."""
+        entry = self.pending.pop(reply_to, None)
+        if entry is None:
+            return False
+        future, sent_at, deadline = entry
+        deadline.cancel()
+        latency = time.monotonic() - sent_at
+        self.acked += 1
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+        if not future.done():
+            future.set_result(message)
+        self._wake_waiters()
+        return True
+
+    def fail_all(self, reason):
+        """Fail every pending message, used when the socket they were sent through is gone."""
+        pending, self.pending = self.pending, {}
+        for message_id, (future, _, deadline) in pending.items():
+            deadline.cancel()
+            self._fail(future, f'Message {message_id} not acknowledged: {reason}')
+        self._wake_waiters()
+
+    def fail(self, message_id, reason):
+        """Fail a pending message, e.g. because it could not be sent."""
+        entry = self.pending.pop(message_id, None)
+        if entry is None:
+            return
+        future, _, deadline = entry
+        deadline.cancel()
+        self._fail(future, f'Message {message_id} not acknowledged: {reason}')
+        self._wake_waiters()
+
+    def _expire(self, message_id):
+        entry = self.pending.pop(message_id, None)
+        if entry is None:
+            return
+        logger.warning(f'Message {message_id} not acknowledged after {self.timeout}s')
+        self._fail(entry[0], f'Message {message_id} not acknowledged after {self.timeout}s')
+        self._wake_waiters()
+
+    def _fail(self, future, reason):
+        self.failed += 1
+        if not future.done():
+            future.set_exception(SlackAckException(reason))
+
+    def _wake_waiters(self):
+        while self._waiters and len(self.pending) < self.window:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+
 class SlackAPI:
     SLACK_RPC_PREFIX = 'https://slack.com/api/'
     SLACK_RTM_EVENTS = (
@@ -62,28 +247,128 @@ class SlackAPI:
         'team_domain_change', 'team_join', 'team_rename', 'tokens_revoked', 'url_verification', 'user_change'
     )
 
-    def __init__(self, bot_token, event_loop=None):
+    # Items requested per page when loading the team snapshot lazily
+    SNAPSHOT_PAGE_SIZE = 200
+    # Web API rate limit tiers, in calls per minute. Methods not listed are considered tier 3
+    SLACK_RATE_TIERS = {1: 1, 2: 20, 3: 50, 4: 100}
+    SLACK_METHOD_TIERS = {
+        'conversations.list': 2, 'conversations.open': 3, 'im.open': 3, 'mpim.open': 3, 'rtm.connect': 1,
+        'rtm.start': 1, 'users.info': 4, 'users.list': 2,
+    }
+    # Read-only or idempotent methods, identical calls in flight at the same time share their response
+    SLACK_DEDUPLICATED_METHODS = frozenset((
+        'conversations.info', 'conversations.list', 'im.open', 'mpim.open', 'users.info', 'users.list',
+    ))
+    # Times a rate limited call is retried before giving up
+    RATE_LIMIT_RETRIES = 3
+    # Seconds to wait for Slack to acknowledge an RTM message
+    ACK_TIMEOUT = 10
+    # RTM messages that can be waiting for acknowledgement at the same time
+    ACK_WINDOW = 100
+    # Seconds to wait before reconnecting after a failed RTM connection, doubled on every failure
+    RECONNECT_BACKOFF = 1
+    RECONNECT_BACKOFF_MAX = 60
+    # Characters sent in a single RTM message, longer ones are split
+    MAX_MESSAGE_LENGTH = 4000
+
+    def __init__(self, bot_token, event_loop=None, lazy_snapshot=False, transport=None, ignore_types=()):
         self.loop = event_loop or asyncio.get_event_loop()
-        self.session = aiohttp.ClientSession(loop=self.loop)
+        self.lazy_snapshot = lazy_snapshot
+        # RTM event types dropped before decoding, they won't reach the internal handlers either
+        self.ignore_types = frozenset(ignore_types)
+        self.rtm_routes = {
+            name[len('handle_'):]: getattr(self, name) for name in dir(self) if name.startswith('handle_')
+        }
+        self.snapshot_loader: Optional[asyncio.Future] = None
+        self.transport = transport
+        self._session: Optional[aiohttp.ClientSession] = None
         self.bot_token = bot_token
-        self.groups = []
-        self.users = []
-        self.channels = []
-        self.mpims = []
-        self.ims = []
-        self.bots = []
+        self.groups = SlackEntityStore()
+        self.users = SlackEntityStore()
+        self.channels = SlackEntityStore()
+        self.mpims = SlackEntityStore()
+        self.ims = SlackEntityStore()
+        self.bots = SlackEntityStore()
+        self.snapshot_taken = False
+        self.reconnect_url: Optional[str] = None
         self.ws_socket = None
+        self.ws_closing = False
         self.ws_ids = 1
-        self.response_futures = {}
+        self.acks = SlackAckTracker(timeout=self.ACK_TIMEOUT, window=self.ACK_WINDOW)
+        self.method_buckets: Dict[str, TokenBucket] = {}
+        self.pending_calls: Dict[tuple, asyncio.Future] = {}
+        self.im_by_user: Dict[str, str] = {}
+        self.mpim_by_members: Dict[frozenset, str] = {}
+        # Keys of the two caches above resolving to each conversation, to forget them without scanning the caches
+        self.conversation_keys: DefaultDict[str, Set[Hashable]] = defaultdict(set)
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """HTTP session to talk to Slack, created on first use and again after being closed."""
+        if self._session is None or self._session.closed:
+            if self.transport:
+                session = self.transport.session()
+            else:
+                session = aiohttp.ClientSession(loop=self.loop)
+            self._session = session
+            return session
+        return self._session
 
     async def request(self, method, url, data=None, headers=None):
         async with self.session.request(method=method, url=url, data=data, headers=headers) as response:
-            return await response.json()
+            if response.status == 429:
+                retry_after = float(response.headers.get('Retry-After', 1))
+                raise SlackRateLimitedException(f'Rate limited, retry after {retry_after}s', method=url,
+                                                retry_after=retry_after)
+            return await response.json(loads=json_codec.loads)
+
+    def method_bucket(self, method) -> TokenBucket:
+        bucket = self.method_buckets.get(method)
+        if bucket is None:
+            calls_per_minute = self.SLACK_RATE_TIERS[self.SLACK_METHOD_TIERS.get(method, 3)]
+            # Allow bursts of up to 10 seconds worth of calls
+            bucket = TokenBucket(rate=calls_per_minute / 60, capacity=max(1, calls_per_minute // 6))
+            self.method_buckets[method] = bucket
+        return bucket
 
     async def call(self, method, **params):
         """
         Call an Slack Web API method
 
+        Calls are paced per method following Slack rate limit tiers, and
+        retried when Slack asks to. Identical calls to the methods in
+        SLACK_DEDUPLICATED_METHODS made while one is in flight share its
+        response.
+
+        :param method: Slack Web API method to call
+        :param params: {str: object} parameters to method
+        :return: dict()
+        """
+        if method not in self.SLACK_DEDUPLICATED_METHODS:
+            return await self.scheduled_call(method, **params)
+        key = (method, tuple(sorted((name, str(value)) for name, value in params.items())))
+        pending = self.pending_calls.get(key)
+        if pending is None:
+            pending = self.pending_calls[key] = asyncio.ensure_future(self.scheduled_call(method, **params))
+            pending.add_done_callback(lambda _: self.pending_calls.pop(key, None))
+        return await asyncio.shield(pending)
+
+    async def scheduled_call(self, method, **params):
+        bucket = self.method_bucket(method)
+        for attempt in range(self.RATE_LIMIT_RETRIES + 1):
+            await bucket.acquire()
+            try:
+                return await self.direct_call(method, **params)
+            except SlackRateLimitedException as e:
+                logger.warning(f'Slack API call {method} rate limited, retrying in {e.retry_after}s')
+                bucket.pause(e.retry_after)
+                if attempt == self.RATE_LIMIT_RETRIES:
+                    raise
+
+    async def direct_call(self, method, **params):
+        """
+        Call an Slack Web API method right away
+
         :param method: Slack Web API method to call
         :param params: {str: object} parameters to method
         :return: dict()
@@ -106,78 +391,184 @@ class SlackAPI:
             raise SlackCallException(f'No OK response returned', method=method)
         return response_body
 
-    async def slack_name_to_id(self, recipient):
-        new_id = recipient
+    async def paginate(self, method, key, **params):
+        """
+        Iterate over the items of a cursor paginated Slack Web API method
+
+        :param method: Slack Web API method to call
+        :param key: key of the response holding the list of items
+        :param params: {str: object} parameters to method
+        """
+        while True:
+            response_body = await self.call(method, **params)
+            for item in response_body.get(key, ()):
+                yield item
+            cursor = response_body.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                break
+            params['cursor'] = cursor
+
+    def conversation_store(self, conversation: dict) -> SlackEntityStore:
+        if conversation.get('is_im'):
+            return self.ims
+        if conversation.get('is_mpim'):
+            return self.mpims
+        if conversation.get('is_group') or conversation.get('is_private'):
+            return self.groups
+        return self.channels
+
+    async def load_snapshot(self):
+        """Fill the entity stores page by page, merging with what RTM events already brought."""
+        page_size = self.SNAPSHOT_PAGE_SIZE
+        async for user in self.paginate('users.list', 'members', limit=page_size):
+            self.users.update(user['id'], user)
+            bot_id = user.get('profile', {}).get('bot_id')
+            if user.get('is_bot') and bot_id:
+                # There is no method listing bots, their users carry what rtm.start sends about them
+                self.bots.update(bot_id, {'name': user.get('name'), 'deleted': user.get('deleted', False),
+                                          'app_id': user['profile'].get('api_app_id')})
+        async for conversation in self.paginate('conversations.list', 'channels', limit=page_size,
+                                                types='public_channel,private_channel,mpim,im'):
+            self.conversation_store(conversation).update(conversation['id'], conversation)
+        logger.info(f'Loaded snapshot of {len(self.users)} users and {len(self.channels)} channels')
+
+    def snapshot_loaded(self, future: asyncio.Future):
+        if future.cancelled():
+            return
+        exception = future.exception()
+        if exception is not None:
+            logger.error('Loading the snapshot failed, it will be retried on the next connection', exc_info=exception)
+            self.snapshot_taken = False
+
+    async def fetch_user(self, user_id):
+        """Return the user, requesting it to Slack if its details are not loaded yet."""
+        user = self.users.get(user_id)
+        if user is None or 'name' not in user:
+            response_body = await self.call('users.info', user=user_id)
+            user = self.users.update(user_id, response_body['user'])
+        return user
+
+    def resolve_name(self, recipient):
+        """Turn @username and #channel names into Slack ids, other recipients are returned as they are."""
         if recipient.startswith('@'):
             username = recipient[1:]
-            users = [user for user in self.users if user['bot_names'] == username and not user['deleted']]
+            users = [user for user in self.users.find_by_name(username) if not user.get('deleted')]
             if len(users) > 1 or not users:
                 logger.error(f'User {username} does not exist')
                 raise SlackUseException(f'User {recipient} does not exist')
-            new_id = users[0]['id']
+            return users[0]['id']
         if recipient.startswith('#'):
             channel_name = recipient[1:]
-            channels = [channel for channel in self.channels if
-                        channel['bot_names'] == channel_name and not channel['archived']]
+            channels = [channel for channel in self.channels.find_by_name(channel_name)
+                        if not channel.get('is_archived')]
             if len(channels) > 1 or not channels:
                 logger.error(f'Channel {channel_name} does not exist')
                 raise SlackUseException(f'Channel {channel_name} does not exist')
-            new_id = channels[0]['id']
+            return channels[0]['id']
+        return recipient
+
+    async def lookup_name(self, recipient):
+        """Like `resolve_name`, but waits for the snapshot being loaded before giving up on a name."""
+        try:
+            return self.resolve_name(recipient)
+        except SlackUseException:
+            if self.snapshot_loader is None or self.snapshot_loader.done():
+                raise
+        logger.debug(f'Waiting for the snapshot to resolve {recipient}')
+        # Neither a failed loading nor cancelling this call are propagated to the loader
+        await asyncio.wait([self.snapshot_loader])
+        return self.resolve_name(recipient)
+
+    async def slack_name_to_id(self, recipient):
+        new_id = await self.lookup_name(recipient)
         if new_id.startswith('U'):
+            new_id = await self.user_to_im(new_id)
+        return new_id
+
+    async def user_to_im(self, user_id):
+        """Return the DM channel with a user, opening it if there is none."""
+        im_id = self.im_by_user.get(user_id)
+        if im_id is None:
             for im in self.ims:
-                if im['user'] == new_id:
-                    new_id = im['id']
+                if im.get('user') == user_id:
+                    im_id = im['id']
                     break
             else:
-                channel = await self.create_im(new_id)
-                new_id = channel['channel']['id']
-        return new_id
+                channel = await self.create_im(user_id)
+                im_id = channel['channel']['id']
+            self.im_by_user[user_id] = im_id
+            self.conversation_keys[im_id].add(user_id)
+        return im_id
 
     async def userids_to_channel(self, userids):
-        userids.sort()
-        for mpim in self.mpims:
-            if sorted(mpim['members']) == userids:
-                return mpim['id']
-        else:
-            mpim = await self.create_mpim(users=userids)
-            return mpim['id']
-
-    def ws_send(self, body: dict):
+        """Return the MPIM channel with a set of users, opening it if there is none."""
+        members = frozenset(userids)
+        mpim_id = self.mpim_by_members.get(members)
+        if mpim_id is None:
+            for mpim in self.mpims:
+                if frozenset(mpim.get('members', ())) == members:
+                    mpim_id = mpim['id']
+                    break
+            else:
+                response = await self.create_mpim(users=sorted(members))
+                self.mpims.update(response['group']['id'], response['group'])
+                mpim_id = response['group']['id']
+            self.mpim_by_members[members] = mpim_id
+            self.conversation_keys[mpim_id].add(members)
+        return mpim_id
+
+    def forget_conversation(self, conversation_id):
+        """Drop the cached DM/MPIM resolutions pointing to a conversation."""
+        for key in self.conversation_keys.pop(conversation_id, ()):
+            cache = self.mpim_by_members if isinstance(key, frozenset) else self.im_by_user
+            if cache.get(key) == conversation_id:
+                del cache[key]
+
+    async def ws_send(self, body: dict) -> asyncio.Future:
+        """Send an RTM message, returns the future of its acknowledgement."""
         assert self.ws_socket and not self.ws_socket.closed, 'Writing to someone is only supported through ws'
-        body['id'] = self.ws_ids
+        message_id = body['id'] = self.ws_ids
         self.ws_ids += 1
         logger.debug(f'Sending {body}')
-        self.ws_socket.send_json(body)
-        future: asyncio.Future
-        future = self.response_futures[body['id']] = asyncio.Future()
+        # Tracked before sending, Slack may reply before send_json returns
+        future = self.acks.track(message_id)
+        try:
+            await self.ws_socket.send_json(body, dumps=json_codec.dumps)
+        except Exception as e:
+            self.acks.fail(message_id, f'sending failed, {e!r}')
+            raise
         return future
 
     async def write_to(self, recipients: Union[List[str], str], message: str):
         if not isinstance(recipients, str) and len(recipients) > 1:
-            recipients_ids = await asyncio.gather(
-                self.slack_name_to_id(recipient=recipient) for recipient in recipients
-            )
+            recipients_ids = [await self.lookup_name(recipient) for recipient in recipients]
             recipient = await self.userids_to_channel(userids=recipients_ids)
         else:
             recipient = recipients
         if recipient[0] in '@#U':  # User cannot be addressed directly, need to do it through DM channel
             recipient = await self.slack_name_to_id(recipient=recipient)
         assert recipient[0] in 'CDG', f'Programming error, receiver should start with (C|D|G) ({recipient}'
-        return self.ws_send({
-            'type': 'message',
-            'channel': recipient,
-            'text': message,
-        })
+        # Blocks are sent in order, so the acknowledgement of the last one is returned
+        for block in chunk_text(message, self.MAX_MESSAGE_LENGTH):
+            await self.acks.wait_available()
+            future = await self.ws_send({
+                'type': 'message',
+                'channel': recipient,
+                'text': block,
+            })
+        return future
 
     async def create_im(self, user: str):
         channel = await self.call('im.open', user=user, return_im=True)
         return channel
 
     async def create_mpim(self, users: List[str]):
-        channel = await self.call('mpim.open', users=users)
+        channel = await self.call('mpim.open', users=','.join(users))
         return channel
 
     def look_for_id(self, iterable, object_id):
+        if isinstance(iterable, SlackEntityStore):
+            return iterable.get(object_id)
         for item in iterable:
             if item['id'] == object_id:
                 break
@@ -190,124 +581,124 @@ class SlackAPI:
         return message
 
     def get_user_by_id(self, user_id):
-        return self.look_for_id(self.users, user_id)
+        return self.users.get(user_id)
 
     handle_accounts_changed = ignore_message
 
     def handle_bot_added(self, message):
         bot_id = message['bot']['id']
-        bot = self.look_for_id(self.bots, bot_id)
+        bot = self.bots.get(bot_id)
         if bot:
             logger.warning(f'Bot {bot_id} is to be added, but already exists, updating')
-            bot.update(message['bot'])
+            self.bots.update(bot_id, message['bot'])
         else:
             logger.debug(f'Adding bot {bot_id}')
             bot = {'deleted': False, 'updated': 0}
             bot.update(message['bot'])
-            self.bots.append(bot)
+            self.bots.add(bot)
         return message
 
     def handle_bot_changed(self, message):
         bot_id = message['bot']['id']
-        bot = self.look_for_id(self.bots, bot_id)
+        bot = self.bots.get(bot_id)
 
         if bot:
             logger.debug(f'Bot {bot_id} changed')
-            bot.update(message['bot'])
+            self.bots.update(bot_id, message['bot'])
         else:
             logger.warning(f'Bot {bot_id} is to be changed, but does not exist, adding')
             bot = {'deleted': False, 'updated': 0}
             bot.update(message['bot'])
-            self.bots.append(bot)
+            self.bots.add(bot)
         return message
 
     def handle_channel_archive(self, message):
         channel_id = message['channel']
-        channel = self.look_for_id(self.channels, channel_id)
+        channel = self.channels.get(channel_id)
         if channel:
             logger.debug(f'Channel {channel_id} has been archived. {message}')
             channel['is_archived'] = True
         else:
             logger.warning(f'Channel {channel_id} is not in the list of known channels, adding')
-            self.channels.append({'id': channel_id, 'is_archived': True, "is_channel": True, })
+            self.channels.add({'id': channel_id, 'is_archived': True, "is_channel": True, })
         return message
 
     def handle_channel_created(self, message):
         channel_id = message['channel']['id']
-        channel = self.look_for_id(self.channels, channel_id)
+        channel = self.channels.get(channel_id)
         if channel:
             logger.warning(f'Channel {channel_id} already exists, updating')
-            channel.update(message['channel'])
+            self.channels.update(channel_id, message['channel'])
         else:
             logger.debug(f'Channel {channel_id} has been created. {message["channel"]}')
-            self.channels.append(dict(is_archived=False, is_channel=True, **message['channel']))
+            self.channels.add(dict(is_archived=False, is_channel=True, **message['channel']))
         return message
 
     def handle_channel_deleted(self, message):
         channel_id = message['channel']
-        channel = self.look_for_id(self.channels, channel_id)
+        channel = self.channels.get(channel_id)
         if channel:
             logger.warning(f'Channel {channel_id} already exists, updating')
-            channel.update(message['channel'])
+            self.channels.update(channel_id, message['channel'])
         else:
             logger.debug(f'Channel {channel_id} has been created. {message["channel"]}')
-            self.channels.append(dict(is_archived=False, is_channel=True, **message['channel']))
+            self.channels.add(dict(is_archived=False, is_channel=True, **message['channel']))
         return message
 
     handle_channel_history_changed = ignore_message
 
     def handle_channel_joined(self, message):
         channel_id = message['channel']['id']
-        channel = self.look_for_id(self.channels, channel_id)
+        channel = self.channels.get(channel_id)
         if channel:
             logger.debug(f'Channel {channel_id} joined')
-            channel.update(message['channel'])
+            self.channels.update(channel_id, message['channel'])
         else:
             logger.warning(f'Joined previously unknown channel {channel_id}')
-            self.channels.append(message['channel'])
+            self.channels.add(message['channel'])
         return message
 
     def handle_channel_left(self, message):
         channel_id = message['channel']
-        channel = self.look_for_id(self.channels, channel_id)
+        channel = self.channels.get(channel_id)
         if channel:
             logger.debug(f'Left channel {channel_id}')
             channel['is_member'] = False
         else:
             logger.warning(f'Left previously unknown channel {channel_id}')
-            self.channels.append(dict(id=channel_id, is_channel=True, ))
+            self.channels.add(dict(id=channel_id, is_channel=True, ))
         return message
 
     def handle_channel_marked(self, message):
         channel_id = message['channel']
-        channel = self.look_for_id(self.channels, channel_id)
+        channel = self.channels.get(channel_id)
         if channel:
             logger.debug(f'Channel mark event for {channel_id}, doing nothing')
         else:
             logger.warning(f'Mark on previously unknown channel {channel_id}')
-            self.channels.append(dict(id=channel_id, is_channel=True, ))
+            self.channels.add(dict(id=channel_id, is_channel=True, ))
         return message
 
     def handle_channel_rename(self, message):
         channel_id = message['channel']['id']
-        channel = self.look_for_id(self.channels, channel_id)
+        channel = self.channels.get(channel_id)
         if channel:
             logger.debug(f'Channel {channel_id} renamed')
-            channel.update(message['channel'])
+            self.channels.update(channel_id, message['channel'])
         else:
             logger.warning(f'Rename of previously unknown channel {channel_id}')
-            self.channels.append(dict(is_channel=True, **message['channel']))
+            self.channels.add(dict(is_channel=True, **message['channel']))
         return message
 
     def handle_channel_unarchive(self, message):
         channel_id = message['channel']
-        channel = self.look_for_id(self.channels, channel_id)
+        channel = self.channels.get(channel_id)
         if channel:
             logger.debug(f'Channel {channel_id} has been unarchived. {message}')
             channel['is_archived'] = False
         else:
             logger.warning(f'Channel {channel_id} is not in the list of known channels, unarchiving')
-            self.channels.append({'id': channel_id, 'is_archived': False, "is_channel": True, })
+            self.channels.add({'id': channel_id, 'is_archived': False, "is_channel": True, })
         return message
 
     handle_commands_changed = ignore_message
@@ -324,97 +715,103 @@ class SlackAPI:
     handle_file_public = ignore_message
     handle_file_shared = ignore_message
     handle_file_unshared = ignore_message
-    handle_goodbye = ignore_message  # TODO: Needs to be handled
+
+    def handle_goodbye(self, message):
+        logger.info('Slack asked to close the connection, reconnecting')
+        # rtm_socket_consume closes the socket once the message is handled
+        self.ws_closing = True
+        return message
+
     handle_grid_migration_finished = ignore_message
     handle_grid_migration_started = ignore_message
 
     def handle_group_archive(self, message):
         group_id = message['channel']
-        group = self.look_for_id(self.groups, group_id)
+        group = self.groups.get(group_id)
         if group:
             logger.debug(f'Group {group_id} has been archived. {message}')
             group['is_archived'] = True
         else:
             logger.warning(f'Group {group_id} is not in the list of known groups, archiving')
-            self.channels.append({'id': group_id, 'is_archived': True, "is_group": True, })
+            self.channels.add({'id': group_id, 'is_archived': True, "is_group": True, })
         return message
 
     def handle_group_close(self, message):
         group_id = message['channel']
-        group = self.look_for_id(self.groups, group_id)
+        group = self.groups.get(group_id)
         if group:
             logger.debug(f'Marking group {group_id} as closed. {message}')
             group['is_open'] = False
         else:
             logger.warning(f'Marking non existent group as closed. {message}')
-            self.groups.append({'is_group': True, 'id': group_id, 'is_open': False})
+            self.groups.add({'is_group': True, 'id': group_id, 'is_open': False})
         return message
 
     handle_group_history_changed = ignore_message
 
     def handle_group_joined(self, message):
         group_id = message['channel']['id']
-        group = self.look_for_id(self.groups, group_id)
+        group = self.groups.get(group_id)
         if group:
             logger.warning(f'Creating already existing group {group_id}. {message}')
-            group.update(message['channel'])
+            self.groups.update(group_id, message['channel'])
         else:
             logger.debug(f'Joined group {group_id}. {message}')
-            self.groups.append(message['channel'])
+            self.groups.add(message['channel'])
         return message
 
     def handle_group_left(self, message):
         group_id = message['channel']
-        group = self.look_for_id(self.groups, group_id)
+        group = self.groups.get(group_id)
         if group:
             logger.debug(f'Left group {group_id}')
             group['is_member'] = False
         else:
             logger.warning(f'Left previously unknown group {group_id}')
-            self.groups.append(dict(id=group_id, is_group=True, ))
+            self.groups.add(dict(id=group_id, is_group=True, ))
         return message
 
     def handle_group_marked(self, message):
         group_id = message['channel']
-        group = self.look_for_id(self.groups, group_id)
+        group = self.groups.get(group_id)
         if group:
             logger.debug(f'Channel mark event for {group_id}, doing nothing')
         else:
             logger.warning(f'Mark on previously unknown group {group_id}')
-            self.groups.append(dict(id=group_id, is_group=True, ))
+            self.groups.add(dict(id=group_id, is_group=True, ))
         return message
 
     def handle_group_open(self, message):
         group_id = message['channel']
-        group = self.look_for_id(self.groups, group_id)
+        group = self.groups.get(group_id)
         if group:
             logger.debug(f'Group {group_id} open')
             group['is_open'] = True
         else:
             logger.warning(f'Open previously unknown group {group_id}')
-            self.groups.append(dict(id=group_id, is_group=True, is_open=True))
+            self.groups.add(dict(id=group_id, is_group=True, is_open=True))
         return message
 
     def handle_group_rename(self, message):
         group_id = message['channel']['id']
-        group = self.look_for_id(self.groups, group_id)
+        group = self.groups.get(group_id)
         if group:
             logger.debug(f'Group {group_id} rename')
-            group['name'] = message['channel']['name']
+            self.groups.update(group_id, {'name': message['channel']['name']})
         else:
             logger.warning(f'Rename previously unknown group {group_id}')
-            self.groups.append(dict(id=group_id, is_group=True, name=message['channel']['name']))
+            self.groups.add(dict(id=group_id, is_group=True, name=message['channel']['name']))
         return message
 
     def handle_group_unarchive(self, message):
         group_id = message['channel']['id']
-        group = self.look_for_id(self.groups, group_id)
+        group = self.groups.get(group_id)
         if group:
             logger.debug(f'Marking group {group_id} unarchived')
             group['is_archived'] = False
         else:
             logger.warning(f'Unarchiving previously unknown group {group_id}')
-            self.groups.append(dict(id=group_id, is_group=True, is_archived=False))
+            self.groups.add(dict(id=group_id, is_group=True, is_archived=False))
         return message
 
     def handle_hello(self, message):
@@ -423,24 +820,29 @@ class SlackAPI:
 
     def handle_im_close(self, message):
         im_id = message['channel']
-        im = self.look_for_id(self.ims, im_id)
+        self.forget_conversation(im_id)
+        im = self.ims.get(im_id)
         if im:
             logger.debug(f'Marking im {im_id} as closed. {message}')
             im['is_open'] = False
         else:
             logger.warning(f'Marking non existent im as closed. {message}')
-            self.ims.append({'is_im': True, 'id': im_id, 'is_open': False})
+            self.ims.add({'is_im': True, 'id': im_id, 'is_open': False})
         return message
 
     def handle_im_created(self, message):
         im_id = message['channel']['id']
-        im = self.look_for_id(self.ims, im_id)
+        self.forget_conversation(im_id)
+        previous_im_id = self.im_by_user.get(message['channel'].get('user'))
+        if previous_im_id is not None:
+            self.forget_conversation(previous_im_id)
+        im = self.ims.get(im_id)
         if im:
             logger.warning(f'Channel {im_id} already exists, updating')
-            im.update(message['im'])
+            self.ims.update(im_id, message['channel'])
         else:
             logger.debug(f'Channel {im_id} has been created. {message}')
-            self.ims.append(dict(is_archived=False, is_im=True, **message['channel']))
+            self.ims.add(dict(is_archived=False, is_im=True, **message['channel']))
         return message
 
     handle_im_history_changed = ignore_message
@@ -448,33 +850,34 @@ class SlackAPI:
 
     def handle_im_open(self, message):
         im_id = message['channel']
-        im = self.look_for_id(self.ims, im_id)
+        im = self.ims.get(im_id)
         if im:
             logger.debug(f'Marking im {im_id} as closed. {message}')
             im['is_open'] = True
         else:
             logger.warning(f'Marking non existent im as closed. {message}')
-            self.ims.append({'is_im': True, 'id': im_id, 'is_open': True})
+            self.ims.add({'is_im': True, 'id': im_id, 'is_open': True})
         return message
 
     def handle_manual_presence_change(self, message):
         user_id = message['user']
-        user = self.look_for_id(self.users, user_id)
+        user = self.users.get(user_id)
         presence = message["presence"]
         if user:
             logger.debug(f'User {user_id} presence manually updated to {presence}')
             user['presence'] = presence
         else:
             logger.warning(f'Setting presence for previously unknown user {user_id}')
-            self.users.append(dict(id=user_id, presence=presence))
+            self.users.add(dict(id=user_id, presence=presence))
         return message
 
     def handle_member_joined_channel(self, message):
         channel_id, channel_type = message['channel'], message['channel_type']
+        self.forget_conversation(channel_id)
         if channel_type == 'C':
-            channel = self.look_for_id(self.channels, channel_id)
+            channel = self.channels.get(channel_id)
         elif channel_type == 'G':
-            channel = self.look_for_id(self.groups, channel_id)
+            channel = self.groups.get(channel_id)
         else:
             logger.warning(f'Unknown type of channel type {channel_type}, ignoring')
             return message
@@ -492,18 +895,19 @@ class SlackAPI:
         else:
             logger.warning(f'Adding previously unknown channel/group {channel_id} the member {user}')
             if channel_type == 'C':
-                self.channels.append({'id': channel_id, 'is_channel': True, 'members': [user]})
+                self.channels.add({'id': channel_id, 'is_channel': True, 'members': [user]})
             elif channel_type == 'G':
-                self.groups.append({'id': channel_id, 'is_group': True, 'members': [user]})
+                self.groups.add({'id': channel_id, 'is_group': True, 'members': [user]})
 
         return message
 
     def handle_member_left_channel(self, message):
         channel_id, channel_type = message['channel'], message['channel_type']
+        self.forget_conversation(channel_id)
         if channel_type == 'C':
-            channel = self.look_for_id(self.channels, channel_id)
+            channel = self.channels.get(channel_id)
         elif channel_type == 'G':
-            channel = self.look_for_id(self.groups, channel_id)
+            channel = self.groups.get(channel_id)
         else:
             logger.warning(f'Unknown type of channel type {channel_type}, ignoring')
             return message
@@ -521,9 +925,9 @@ class SlackAPI:
         else:
             logger.warning(f'Adding previously unknown channel/group {channel_id} with empty members (no {user})')
             if channel_type == 'C':
-                self.channels.append({'id': channel_id, 'is_channel': True, 'members': []})
+                self.channels.add({'id': channel_id, 'is_channel': True, 'members': []})
             elif channel_type == 'G':
-                self.groups.append({'id': channel_id, 'is_group': True, 'members': []})
+                self.groups.add({'id': channel_id, 'is_group': True, 'members': []})
 
         return message
 
@@ -533,19 +937,24 @@ class SlackAPI:
 
     def handle_presence_change(self, message):
         user_id = message['user']
-        user = self.look_for_id(self.users, user_id)
+        user = self.users.get(user_id)
         presence = message["presence"]
         if user:
             logger.debug(f'User {user_id} presence updated to {presence}')
             user['presence'] = presence
         else:
             logger.warning(f'Setting presence for previously unknown user {user_id}')
-            self.users.append(dict(id=user_id, presence=presence))
+            self.users.add(dict(id=user_id, presence=presence))
         return message
 
     handle_reaction_added = ignore_message
     handle_reaction_removed = ignore_message
-    handle_reconnect_url = ignore_message
+
+    def handle_reconnect_url(self, message):
+        logger.debug(f'Updating reconnect url. {message}')
+        self.reconnect_url = message['url']
+        return message
+
     handle_star_added = ignore_message
     handle_star_removed = ignore_message
     handle_subteam_created = ignore_message
@@ -557,14 +966,14 @@ class SlackAPI:
 
     def handle_team_join(self, message):
         user_id = message['user']['id']
-        user = self.look_for_id(self.users, user_id)
+        user = self.users.get(user_id)
 
         if user:
             logger.warning(f'User {user} that was just created already existed. {message}')
-            user.update(message['user'])
+            self.users.update(user_id, message['user'])
         else:
             logger.debug(f'Adding user {user_id} changed. {message}')
-            self.users.append(message['user'])
+            self.users.add(message['user'])
         return message
 
     handle_team_migration_started = ignore_message
@@ -577,14 +986,14 @@ class SlackAPI:
 
     def handle_user_change(self, message):
         user_id = message['user']['id']
-        user = self.look_for_id(self.users, user_id)
+        user = self.users.get(user_id)
 
         if user:
             logger.debug(f'User {user} updated. {message}')
-            user.update(message['user'])
+            self.users.update(user_id, message['user'])
         else:
             logger.warning(f'Previously non existent user {user_id} changed. {message}')
-            self.users.append(message['user'])
+            self.users.add(message['user'])
         return message
 
     handle_user_typing = ignore_message
@@ -597,23 +1006,23 @@ class SlackAPI:
         :param message:
         :return: Boolean if message should be yielded
         """
-        message = json.loads(ws_message.data)
-        if 'reply_to' in message:
-            reply_to = message['reply_to']
-            future = self.response_futures.pop(reply_to, None)
-            if future is None:
-                logger.error(f'This should not happen, received reply to unknown message! {message}')
+        if self.ignore_types:
+            frame_type = RTM_FRAME_TYPE.match(ws_message.data)
+            if frame_type and frame_type.group(1) in self.ignore_types:
                 return None
-            future.set_result(message)
+        message = json_codec.loads(ws_message.data)
+        if 'reply_to' in message:
+            if not self.acks.resolve(message['reply_to'], message):
+                logger.error(f'Received reply to unknown or expired message! {message}')
             return None
         if 'type' not in message:
             logger.error(f'No idea what this could be {message}')
             return
         message_type = message['type']
 
-        if hasattr(self, f'handle_{message_type}'):
-            function = getattr(self, f'handle_{message_type}')
-            return function(message)
+        handler = self.rtm_routes.get(message_type)
+        if handler:
+            return handler(message)
 
         if message_type in self.SLACK_RTM_EVENTS:
             logger.debug(f'Unhandled {message_type}. {message}')
@@ -621,30 +1030,83 @@ class SlackAPI:
             logger.warning(f'Unknown {message_type}. {message}')
         return message
 
+    async def rtm_connect(self):
+        """Return the url to open the RTM websocket, only the first connection loads the entity stores."""
+        if self.reconnect_url:
+            url, self.reconnect_url = self.reconnect_url, None
+            return url
+        if self.snapshot_taken or self.lazy_snapshot:
+            # Only get the websocket url, entities are loaded in the background or kept from previous connections
+            response = await self.call('rtm.connect')
+            if not self.snapshot_taken:
+                self.snapshot_loader = asyncio.ensure_future(self.load_snapshot())
+                self.snapshot_loader.add_done_callback(self.snapshot_loaded)
+        else:
+            response = await self.call('rtm.start', simple_latest=False, no_unreads=False, mpim_aware=True)
+            self.channels = SlackEntityStore(response['channels'])
+            self.groups = SlackEntityStore(response['groups'])
+            self.ims = SlackEntityStore(response['ims'])
+            self.mpims = SlackEntityStore(response['mpims'])
+            self.users = SlackEntityStore(response['users'])
+            self.bots = SlackEntityStore(response['bots'])
+            self.im_by_user.clear()
+            self.mpim_by_members.clear()
+            self.conversation_keys.clear()
+        self.snapshot_taken = True
+        return response['url']
+
+    def reconnect_delay(self, failures):
+        if not failures:
+            return 0
+        delay = min(self.RECONNECT_BACKOFF_MAX, self.RECONNECT_BACKOFF * 2 ** (failures - 1))
+        return random.uniform(delay / 2, delay)
+
     async def rtm_api_consume(self):
-        response = await self.call('rtm.start', simple_latest=False, no_unreads=False, mpim_aware=True)
-        self.channels = response['channels']
-        self.groups = response['groups']
-        self.ims = response['ims']
-        self.mpims = response['mpims']
-        self.users = response['users']
-        self.bots = response['bots']
-        logger.debug(f'Connect url {response["url"]}')
-        async with self.session.ws_connect(url=response['url']) as self.ws_socket:
-            async for ws_message in self.ws_socket:
-                if ws_message.tp == WSMsgType.text:
-                    message_content = self.rtm_handler(ws_message=ws_message)
-                    if message_content:
+        failures = 0
+        try:
+            while True:
+                await asyncio.sleep(self.reconnect_delay(failures))
+                failures += 1
+                try:
+                    url = await self.rtm_connect()
+                    logger.debug(f'Connect url {url}')
+                    async for message_content in self.rtm_socket_consume(url):
+                        failures = 0
                         yield message_content
-                elif ws_message.tp in (WSMsgType.closed, WSMsgType.error):
-                    logger.info('Finishing ws, %s', ws_message)
-                    if not self.ws_socket.closed:
-                        await self.ws_socket.close()
-                    break
-
-    def __del__(self):
-        asyncio.ensure_future(self.session.close(), loop=self.loop)
-        self.session.close()
+                except (ClientError, asyncio.TimeoutError):
+                    logger.exception('RTM connection failed')
+                logger.info(f'RTM connection finished, reconnecting ({failures} failed attempts)')
+        finally:
+            if self.snapshot_loader and not self.snapshot_loader.done():
+                self.snapshot_loader.cancel()
+                self.snapshot_taken = False
+            if not self.transport:
+                # Sessions of a shared transport are closed along with it
+                await self.close()
+
+    async def rtm_socket_consume(self, url):
+        self.ws_closing = False
+        try:
+            async with self.session.ws_connect(url=url) as self.ws_socket:
+                async for ws_message in self.ws_socket:
+                    if ws_message.tp == WSMsgType.text:
+                        message_content = self.rtm_handler(ws_message=ws_message)
+                        if message_content:
+                            yield message_content
+                        if self.ws_closing:
+                            await self.ws_socket.close()
+                            break
+                    elif ws_message.tp in (WSMsgType.closed, WSMsgType.error):
+                        logger.info('Finishing ws, %s', ws_message)
+                        if not self.ws_socket.closed:
+                            await self.ws_socket.close()
+                        break
+        finally:
+            self.acks.fail_all('websocket closed')
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
 
 
 for method in dir(SlackAPI):
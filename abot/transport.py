@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+
+import logging
+from typing import List, Optional
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+
+class HttpTransport:
+    """HTTP connection pool shared by all the Backends of a Bot.
+
+    Each Backend gets its own ClientSession, as cookies and default headers
+    belong to the session, but all of them use the same connector. Sockets,
+    TLS connections and DNS resolutions are then reused across Backends.
+    """
+
+    def __init__(self, *, limit: int = 100, limit_per_host: int = 0, keepalive_timeout: float = 30,
+                 ttl_dns_cache: Optional[int] = 300):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.ttl_dns_cache = ttl_dns_cache
+        self._connector: Optional[aiohttp.TCPConnector] = None
+        self._sessions: List[aiohttp.ClientSession] = []
+
+    @property
+    def connector(self) -> aiohttp.TCPConnector:
+        if self._connector is None or self._connector.closed:
+            self._connector = aiohttp.TCPConnector(
+                limit=self.limit, limit_per_host=self.limit_per_host, keepalive_timeout=self.keepalive_timeout,
+                use_dns_cache=self.ttl_dns_cache is not None, ttl_dns_cache=self.ttl_dns_cache,
+            )
+        return self._connector
+
+    def session(self, **kwargs) -> aiohttp.ClientSession:
+        """Create a ClientSession on top of the shared connector, closed along with the transport."""
+        session = aiohttp.ClientSession(connector=self.connector, connector_owner=False, **kwargs)
+        self._sessions.append(session)
+        return session
+
+    async def close(self):
+        sessions, self._sessions = self._sessions, []
+        for session in sessions:
+            if not session.closed:
+                await session.close()
+        if self._connector is not None:
+            logger.debug('Closing shared HTTP connector')
+            await self._connector.close()
+            self._connector = None
@@ -2,32 +2,313 @@
 from __future__ import absolute_import, print_function, unicode_literals
 
 import asyncio
+import json
 import logging
-from typing import AsyncIterator, Dict, Optional
+import time
+from collections import Counter, OrderedDict
+from typing import AsyncIterator, Awaitable, Dict, Hashable, Iterable, List, Mapping, Optional
 
 logger = logging.getLogger(__name__)
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore
 
-async def iterator_merge(iterators: Dict[AsyncIterator, Optional[asyncio.Future]]):
-    while iterators:
-        for iterator, value in list(iterators.items()):
-            if not value:
-                iterators[iterator] = asyncio.ensure_future(iterator.__anext__())
 
-        tasks, _ = await asyncio.wait(iterators.values(), return_when=asyncio.FIRST_COMPLETED)  # type: ignore
-        for task in tasks:
-            # We send the result up
+class JsonCodec:
+    """JSON encoding and decoding for wire formats, using the fastest implementation available."""
+
+    def __init__(self, name, loads, dumps):
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+
+    def __repr__(self):
+        return f'<JsonCodec {self.name}>'
+
+    @classmethod
+    def stdlib(cls):
+        return cls('json', json.loads, json.dumps)
+
+    @classmethod
+    def fastest(cls):
+        if orjson is not None:
+            return cls('orjson', orjson.loads, lambda obj: orjson.dumps(obj).decode())
+        return cls.stdlib()
+
+
+json_codec = JsonCodec.fastest()
+
+
+# Kinds of entries pushed by IteratorMerger pumps to the shared queue
+_ITEM, _ERROR, _DONE = range(3)
+
+
+class IteratorMerger:
+    """Merge several async iterators into one, yielding items as they arrive.
+
+    Each source is consumed by its own task, which pushes into a shared
+    queue bounded by `maxsize`, so the consumer waits on a single queue and
+    a slow consumer stops all the sources. `fair_share` limits how many items
+    a single source can have waiting in the queue, so one flooding source
+    cannot take it over.
+
+    If any source raises, the rest are cancelled, the merger is closed and
+    the exception is raised to the consumer; iterating a closed merger raises
+    `RuntimeError`. Stopping the iteration on the consumer side (e.g. an
+    exception in the body of an `async for`) leaves the sources running, so
+    iteration can be resumed; `aclose` must be called to stop them.
+    """
+
+    def __init__(self, iterators: Iterable[AsyncIterator], *, maxsize: int = 100, fair_share: Optional[int] = None):
+        # Mappings are accepted for compatibility, values being the pending __anext__ future, if any
+        if isinstance(iterators, Mapping):
+            self._sources = list(iterators.items())
+        else:
+            self._sources = [(iterator, None) for iterator in iterators]
+        self.maxsize = maxsize
+        self.fair_share = fair_share
+        self._queue: Optional[asyncio.Queue] = None
+        self._pumps: List[asyncio.Future] = []
+        self._running = 0
+        self._closed = False
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def _start(self) -> asyncio.Queue:
+        queue = self._queue = asyncio.Queue(maxsize=self.maxsize)
+        for iterator, pending in self._sources:
+            slots = asyncio.Semaphore(self.fair_share) if self.fair_share else None
+            self._pumps.append(asyncio.ensure_future(self._pump(queue, iterator, pending, slots)))
+        self._running = len(self._pumps)
+        return queue
+
+    async def _pump(self, queue: asyncio.Queue, iterator: AsyncIterator, pending: Optional[asyncio.Future],
+                    slots: Optional[asyncio.Semaphore]):
+        try:
+            await self._pump_items(queue, iterator, pending, slots)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await queue.put((_ERROR, e, None))
+        else:
+            await queue.put((_DONE, iterator, None))
+
+    async def _pump_items(self, queue: asyncio.Queue, iterator: AsyncIterator, pending: Optional[asyncio.Future],
+                          slots: Optional[asyncio.Semaphore]):
+        if pending is not None:
             try:
-                res = task.result()
-                yield res
+                item = await pending
             except StopAsyncIteration:
-                # We remove the task from the list
-                for it, old_next in list(iterators.items()):
-                    if task is old_next:
-                        logger.debug(f'Iterator {it} finished consuming')
-                        iterators.pop(it)
+                return
+            if slots is not None:
+                await slots.acquire()
+            await queue.put((_ITEM, item, slots))
+        async for item in iterator:
+            if slots is not None:
+                await slots.acquire()
+            await queue.put((_ITEM, item, slots))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._closed:
+            raise RuntimeError('IteratorMerger is closed')
+        queue = self._queue
+        if queue is None:
+            queue = self._start()
+        while self._running:
+            kind, value, slots = await queue.get()
+            if kind == _ITEM:
+                if slots is not None:
+                    slots.release()
+                return value
+            elif kind == _DONE:
+                logger.debug(f'Iterator {value} finished consuming')
+                self._running -= 1
             else:
-                # We remove the task from the key
-                for it, old_next in list(iterators.items()):
-                    if task is old_next:
-                        iterators[it] = None
+                await self.aclose()
+                raise value
+        raise StopAsyncIteration
+
+    async def aclose(self):
+        pumps, self._pumps = self._pumps, []
+        self._running = 0
+        self._closed = True
+        for pump in pumps:
+            pump.cancel()
+        await asyncio.gather(*pumps, return_exceptions=True)
+
+
+def retrieve_exception(future: asyncio.Future):
+    """Done callback for futures their creator may ignore, to avoid asyncio warning of unretrieved exceptions."""
+    if not future.cancelled():
+        future.exception()
+
+
+async def iterator_merge(iterators: Dict[AsyncIterator, Optional[asyncio.Future]]):
+    merger = IteratorMerger(iterators)
+    try:
+        async for item in merger:
+            yield item
+    finally:
+        await merger.aclose()
+
+
+class TaskRegistry:
+    """Keep track of the tasks spawned to handle events, limiting how many run at once.
+
+    `limit` bounds the number of tasks in flight overall and `key_limit` the
+    ones in flight for each key (e.g. each handler). When a limit is reached
+    `spawn` waits until some task finishes, which stops the caller from
+    consuming more events in the meantime.
+    """
+
+    def __init__(self, limit: Optional[int] = None, key_limit: Optional[int] = None):
+        self.limit = limit
+        self.key_limit = key_limit
+        self.tasks: Dict[asyncio.Future, Hashable] = {}
+        self._key_counts: Counter = Counter()
+        self._waiters: List[asyncio.Future] = []
+
+    def in_flight(self, key: Hashable = None) -> int:
+        if key is None:
+            return len(self.tasks)
+        return self._key_counts[key]
+
+    def is_full(self, key: Hashable = None) -> bool:
+        if self.limit is not None and len(self.tasks) >= self.limit:
+            return True
+        if key is not None and self.key_limit is not None and self._key_counts[key] >= self.key_limit:
+            return True
+        return False
+
+    async def wait_available(self, key: Hashable = None):
+        while self.is_full(key):
+            waiter = asyncio.get_event_loop().create_future()
+            self._waiters.append(waiter)
+            logger.debug(f'Task registry is full ({self.in_flight()} in flight), waiting')
+            await waiter
+
+    async def spawn(self, coro: Awaitable, key: Hashable = None) -> asyncio.Future:
+        await self.wait_available(key)
+        task = asyncio.ensure_future(coro)
+        self.tasks[task] = key
+        self._key_counts[key] += 1
+        task.add_done_callback(self._task_done)
+        return task
+
+    async def cancel_all(self):
+        """Cancel the tasks in flight and wait until all of them are finished."""
+        tasks = list(self.tasks)
+        if not tasks:
+            return
+        logger.debug(f'Cancelling {len(tasks)} tasks in flight')
+        for task in tasks:
+            task.cancel()
+        await asyncio.wait(tasks)
+
+    def _task_done(self, task: asyncio.Future):
+        key = self.tasks.pop(task)
+        self._key_counts[key] -= 1
+        if not self._key_counts[key]:
+            del self._key_counts[key]
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+
+class TokenBucket:
+    """Rate limiter allowing `rate` operations per second, in bursts of up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """Return the seconds to wait until a token is available."""
+        self._refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def pause(self, seconds: float):
+        """Make sure no token is available for the given seconds."""
+        self._refill()
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    async def acquire(self):
+        while True:
+            delay = self.delay()
+            if delay <= 0:
+                self.tokens -= 1
+                return
+            await asyncio.sleep(delay)
+
+
+class LRUCache:
+    """Mapping of up to `maxsize` entries, dropping the least recently used ones when full."""
+
+    def __init__(self, maxsize: int = 128):
+        self.maxsize = maxsize
+        self._entries: OrderedDict = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        try:
+            value = self._entries[key]
+        except KeyError:
+            return default
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+
+def chunk_text(text: str, limit: Optional[int]) -> List[str]:
+    """Split text into blocks of up to `limit` characters, cutting at line ends when possible."""
+    if not limit:
+        return [text]
+    chunks = []
+    current = None
+    for line in text.splitlines():
+        while len(line) > limit:
+            if current is not None:
+                chunks.append(current)
+                current = None
+            chunks.append(line[:limit])
+            line = line[limit:]
+        if current is None:
+            current = line
+        elif len(current) + len(line) < limit:
+            current = f'{current}\n{line}'
+        else:
+            chunks.append(current)
+            current = line
+    if current is not None:
+        chunks.append(current)
+    return chunks or [text]
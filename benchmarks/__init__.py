@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(name, params, samples, elapsed):
+    """Build the result record of a benchmark run from its per-operation timings (in seconds)."""
+    return {
+        'benchmark': name,
+        'params': params,
+        'operations': len(samples),
+        'operations_per_second': len(samples) / elapsed if elapsed else None,
+        'mean_us': statistics.mean(samples) * 1e6 if samples else None,
+        'p50_us': percentile(samples, 0.5) * 1e6 if samples else None,
+        'p99_us': percentile(samples, 0.99) * 1e6 if samples else None,
+    }
+
+
+def current_commit():
+    try:
+        return subprocess.check_output('git rev-parse HEAD'.split(), stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def write_results(results, output=None):
+    """Dump results as JSON, with enough metadata to compare them across commits."""
+    document = {
+        'commit': current_commit(),
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    if output:
+        with open(output, 'w') as f:
+            json.dump(document, f, indent=2)
+    else:
+        json.dump(document, sys.stdout, indent=2)
+        sys.stdout.write('\n')
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks of command line parsing.
+
+Run from the repository root with ``python -m benchmarks.commands``. The
+same command, with a growing number of options, is parsed through plain
+click and through ``abot.cli``, and reports parses per second and p50/p99
+parsing latency.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import argparse
+import logging
+import time
+
+import click
+
+from abot import cli
+from benchmarks import summarize, write_results
+
+OPTION_COUNTS = (1, 10, 50)
+
+
+def make_command(decorator, options):
+    def play(**kwargs):
+        pass
+
+    for index in range(options):
+        play = click.option(f'--option{index}', f'-o{index}', type=int, default=0)(play)
+    return decorator(name='play')(click.argument('song')(play))
+
+
+def bench_parse(engine, parses, options):
+    decorator = cli.command if engine == 'abot' else click.command
+    command = make_command(decorator, options)
+    args = ['some song', '--option0', '1', f'--option{options - 1}', '2']
+
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(parses):
+        parse_start = time.perf_counter()
+        command.make_context('play', list(args))
+        latencies.append(time.perf_counter() - parse_start)
+    elapsed = time.perf_counter() - start
+    return summarize('parse', {'engine': engine, 'parses': parses, 'options': options}, latencies, elapsed)
+
+
+def run(parses):
+    return [bench_parse(engine, parses, options) for options in OPTION_COUNTS for engine in ('click', 'abot')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--parses', type=int, default=5000, help='Parses per benchmark')
+    parser.add_argument('--output', help='File to write the JSON results to, stdout by default')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    write_results(run(args.parses), args.output)
+
+
+if __name__ == '__main__':
+    main()
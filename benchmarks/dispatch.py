@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks of the Bot dispatch path.
+
+Run from the repository root with ``python -m benchmarks.dispatch``. Each
+benchmark varies one dimension from a baseline (10 handlers, MRO depth 1,
+1 backend) and reports events per second and p50/p99 dispatch latency.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import argparse
+import asyncio
+import logging
+import time
+
+from abot import cli
+from abot.bot import Bot
+from benchmarks import summarize, write_results
+from tests.dummy_backend import DummyBackend, DummyEvent
+
+BASELINE = {'handlers': 10, 'mro_depth': 1, 'backends': 1}
+VARIATIONS = {
+    'handlers': (1, 10, 100, 200),
+    'mro_depth': (1, 5, 20),
+    'backends': (1, 5, 20),
+}
+COMMAND_TREE_SIZES = (10, 100, 1000)
+
+
+def make_event_class(depth):
+    event_class = DummyEvent
+    for level in range(1, depth):
+        event_class = type(f'DummyEvent{level}', (event_class,), {})
+    return event_class
+
+
+def make_handler(counter):
+    async def handler(event):
+        counter()
+
+    return handler
+
+
+async def bench_dispatch(events, handlers, mro_depth, backends):
+    bot = Bot()
+    event_class = make_event_class(mro_depth)
+    done = asyncio.Event()
+    handled = 0
+    target = events * handlers
+
+    def count():
+        nonlocal handled
+        handled += 1
+        if handled >= target:
+            done.set()
+
+    for _ in range(handlers):
+        bot.add_event_handler(event_class, func=make_handler(count))
+
+    for _ in range(backends):
+        backend = DummyBackend()
+        # Backends are consumed again once exhausted, so this is an endless stream
+        backend.events = [event_class() for _ in range(max(1, events // backends))]
+        bot.attach_backend(backend)
+
+    latencies = []
+    handle_event = bot._handle_event
+
+    async def timed_handle_event(event):
+        start = time.perf_counter()
+        await handle_event(event)
+        latencies.append(time.perf_counter() - start)
+
+    bot._handle_event = timed_handle_event  # type: ignore
+
+    start = time.perf_counter()
+    running = asyncio.ensure_future(bot._run_forever())
+    await done.wait()
+    elapsed = time.perf_counter() - start
+    running.cancel()
+    await asyncio.gather(running, return_exceptions=True)
+
+    params = {'events': events, 'handlers': handlers, 'mro_depth': mro_depth, 'backends': backends}
+    return summarize('dispatch', params, latencies, elapsed)
+
+
+class BenchMessage:
+    def __init__(self, text):
+        self.text = text
+
+    async def reply(self, text):
+        pass
+
+
+async def bench_commands(messages, tree_size):
+    @cli.group()
+    async def commands():
+        pass
+
+    async def noop():
+        pass
+
+    for index in range(tree_size):
+        commands.command(name=f'cmd{index}')(noop)
+
+    collection = cli.CommandCollection(sources=[commands])
+    texts = [BenchMessage(f'bot cmd{index % tree_size}') for index in range(messages)]
+
+    latencies = []
+    start = time.perf_counter()
+    for message in texts:
+        message_start = time.perf_counter()
+        await collection.async_message(message)
+        latencies.append(time.perf_counter() - message_start)
+    elapsed = time.perf_counter() - start
+
+    return summarize('commands', {'messages': messages, 'tree_size': tree_size}, latencies, elapsed)
+
+
+async def run(events, messages):
+    results = []
+    for dimension, values in VARIATIONS.items():
+        for value in values:
+            params = dict(BASELINE, **{dimension: value})
+            results.append(await bench_dispatch(events, **params))
+    for tree_size in COMMAND_TREE_SIZES:
+        results.append(await bench_commands(messages, tree_size))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=2000, help='Events dispatched per benchmark')
+    parser.add_argument('--messages', type=int, default=2000, help='Commands executed per benchmark')
+    parser.add_argument('--output', help='File to write the JSON results to, stdout by default')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    loop = asyncio.get_event_loop()
+    results = loop.run_until_complete(run(args.events, args.messages))
+    write_results(results, args.output)
+
+
+if __name__ == '__main__':
+    main()
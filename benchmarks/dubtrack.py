@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks of the Dubtrack websocket frame decoder.
+
+Run from the repository root with ``python -m benchmarks.dubtrack``. A
+busy room traffic mix (heartbeats, presence, chat, votes and user updates)
+is decoded with the layer loggers quiet and with debug logging enabled,
+and reports frames per second and p50/p99 decoding latency.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import argparse
+import json
+import logging
+import time
+
+from abot import dubtrack
+from benchmarks import summarize, write_results
+
+DUBTRACK_USER = {
+    '__v': 0, '_force_updated': 1516971162191, '_id': '560b135c7ae1ea0300869b20', 'created': 1443566427591,
+    'dubs': 0, 'roleid': 1, 'status': 1, 'username': 'txomon',
+    'userInfo': {'__v': 0, '_id': '560b135c7ae1ea0300869b21', 'userid': '560b135c7ae1ea0300869b20'},
+}
+DUBTRACK_QUEUE_OBJECT = {
+    '__v': 0, '_id': '5628db0a3883a45600b7e68f', '_user': '560b135c7ae1ea0300869b20', 'active': True,
+    'authorized': True, 'dubs': 368, 'order': 99999, 'ot_token': None, 'playedCount': 1677,
+    'queuePaused': None, 'roleid': '52d1ce33c38a06510c000001', 'roomid': '561b1e59c90a9c0e00df610b',
+    'skippedCount': 0, 'songsInQueue': 0, 'updated': 1518771989676, 'userid': '560b135c7ae1ea0300869b20',
+    'waitLine': 0,
+}
+DUBTRACK_CHAT = {
+    'chatid': '560b135c7ae1ea0300869b20-1518783003490', 'message': 'this is going goood :P',
+    'queue_object': DUBTRACK_QUEUE_OBJECT, 'time': 1518783003490, 'type': 'chat-message', 'user': DUBTRACK_USER,
+}
+DUBTRACK_DUB = {
+    'dubtype': 'updub', 'type': 'room_playlist-dub', 'user': DUBTRACK_USER,
+    'playlist': {
+        '__v': 0, '_id': '5a8453cad51c3101003df01c', '_song': '5a0db972fd20620100678621',
+        '_user': '56a80c626894b9410067b716', 'created': 1518621640481, 'downdubs': 1, 'isActive': True,
+        'isPlayed': False, 'order': 2, 'played': 1518782587986, 'roomid': '561b1e59c90a9c0e00df610b',
+        'skipped': False, 'songLength': 221000, 'songid': '5a0db972fd20620100678621', 'updubs': 0,
+        'userid': '56a80c626894b9410067b716',
+    },
+}
+DUBTRACK_USER_UPDATE = {'type': 'user_update_560b135c7ae1ea0300869b20', 'user': DUBTRACK_QUEUE_OBJECT}
+
+
+def room_frame(content):
+    envelope = {
+        'action': 15, 'channel': 'room:561b1e59c90a9c0e00df610b',
+        'message': {'type': 'json', 'name': content['type'], 'data': json.dumps(content)},
+    }
+    return f'4{json.dumps(envelope)}'
+
+
+def presence_frame(action):
+    presence = {'action': action, 'clientId': 'other-client', 'connectionId': 'other-connection', 'data': {}}
+    return '4' + json.dumps({'action': 14, 'channel': 'room:561b1e59c90a9c0e00df610b', 'presence': presence})
+
+
+# Relative frequency of each frame in a busy room
+ROOM_TRAFFIC = (
+    [room_frame(DUBTRACK_CHAT)] * 4 + [room_frame(DUBTRACK_DUB)] * 3 + [room_frame(DUBTRACK_USER_UPDATE)] * 3 +
+    [room_frame({'type': 'chat-skip', 'username': 'txomon'}), presence_frame(0), presence_frame(1), '3']
+)
+
+
+def bench_decode(frames, log_level):
+    dubtrackws = dubtrack.DubtrackWS('room')
+    decoder = dubtrackws.frame_decoder
+    loggers = [dubtrack.logger_layer1, dubtrack.logger_layer2, dubtrack.logger_layer3]
+    previous_levels = [logger.level for logger in loggers]
+    for logger in loggers:
+        logger.setLevel(log_level)
+
+    latencies = []
+    try:
+        start = time.perf_counter()
+        for index in range(frames):
+            frame = ROOM_TRAFFIC[index % len(ROOM_TRAFFIC)]
+            frame_start = time.perf_counter()
+            decoder.decode(frame)
+            latencies.append(time.perf_counter() - frame_start)
+        elapsed = time.perf_counter() - start
+    finally:
+        for logger, level in zip(loggers, previous_levels):
+            logger.setLevel(level)
+
+    params = {'frames': frames, 'log_level': logging.getLevelName(log_level)}
+    return summarize('dubtrack_decode', params, latencies, elapsed)
+
+
+def run(frames):
+    return [bench_decode(frames, log_level) for log_level in (logging.WARNING, logging.DEBUG)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--frames', type=int, default=20000, help='Frames decoded per benchmark')
+    parser.add_argument('--output', help='File to write the JSON results to, stdout by default')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    write_results(run(args.frames), args.output)
+
+
+if __name__ == '__main__':
+    main()
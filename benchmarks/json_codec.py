@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks of the JSON codecs used to decode wire traffic.
+
+Run from the repository root with ``python -m benchmarks.json_codec``. Each
+sample frame is decoded the way its backend does it, with the stdlib codec
+and with the one ``abot.util.json_codec`` picked, and reports frames per
+second and p50/p99 decoding latency.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import argparse
+import json
+import logging
+import time
+
+from abot.util import json_codec, JsonCodec
+from benchmarks import summarize, write_results
+from benchmarks.dubtrack import DUBTRACK_CHAT, room_frame
+
+SLACK_FRAMES = [
+    {'type': 'user_typing', 'channel': 'C2147483705', 'user': 'U2147483697'},
+    {'type': 'presence_change', 'user': 'U2147483697', 'presence': 'away'},
+    {'type': 'message', 'channel': 'C2147483705', 'user': 'U2147483697', 'text': 'Hello world',
+     'ts': '1355517523.000005', 'team': 'T2147483680', 'source_team': 'T2147483680', 'user_team': 'T2147483680'},
+    {'ok': True, 'reply_to': 1, 'ts': '1355517523.000005', 'text': 'Hello world'},
+]
+
+
+def decode_slack(codec, frame):
+    return codec.loads(frame)
+
+
+def decode_dubtrack(codec, frame):
+    envelope = codec.loads(frame[1:])
+    return codec.loads(envelope['message']['data'])
+
+
+TRAFFIC = {
+    'slack': (decode_slack, [json.dumps(frame) for frame in SLACK_FRAMES]),
+    'dubtrack': (decode_dubtrack, [room_frame(DUBTRACK_CHAT), room_frame({'type': 'chat-skip', 'username': 'txomon'})]),
+}
+
+
+def bench_decode(codec, backend, frames):
+    decode, samples = TRAFFIC[backend]
+    latencies = []
+    start = time.perf_counter()
+    for index in range(frames):
+        frame = samples[index % len(samples)]
+        frame_start = time.perf_counter()
+        decode(codec, frame)
+        latencies.append(time.perf_counter() - frame_start)
+    elapsed = time.perf_counter() - start
+    return summarize('json_decode', {'codec': codec.name, 'backend': backend, 'frames': frames}, latencies, elapsed)
+
+
+def run(frames):
+    codecs = [JsonCodec.stdlib()]
+    if json_codec.name != codecs[0].name:
+        codecs.append(json_codec)
+    return [bench_decode(codec, backend, frames) for backend in TRAFFIC for codec in codecs]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--frames', type=int, default=20000, help='Frames decoded per benchmark')
+    parser.add_argument('--output', help='File to write the JSON results to, stdout by default')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    write_results(run(args.frames), args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -115,7 +115,7 @@ setup(
         'License :: OSI Approved :: MIT License',
         'Programming Language :: Python :: 3.6',
     ],
-    packages=find_packages(exclude=['tests']),
+    packages=find_packages(exclude=['tests', 'benchmarks']),
     license='MIT',
     python_requires='>=3.7',
     include_package_data=True,
@@ -125,4 +125,7 @@ setup(
         'aiohttp',
         'click',
     ],
+    extras_require={
+        'speedups': ['orjson'],
+    },
 )
@@ -107,6 +107,29 @@ def test_backend_is_mentioned(text: str, succeeds: bool, dummy_backend: DummyBac
     assert bool(dummy_backend.is_mentioned(event_mock)) == succeeds
 
 
+def test_backend_mention_matcher(dummy_backend: DummyBackend):
+    dummy_backend.me.username = 'txomon'
+    matcher = dummy_backend.get_mention_matcher()
+    assert matcher is dummy_backend.get_mention_matcher()
+
+    # Identity changes recompile the matcher
+    dummy_backend.me.username = 'abot'
+    new_matcher = dummy_backend.get_mention_matcher()
+    assert new_matcher is not matcher
+    assert new_matcher.match('abot: ping') == 'abot'
+    assert new_matcher.match('txomon: ping') is None
+
+    dummy_backend.mention_aliases = lambda: ('bot', 'abot.')
+    event_mock = mock.MagicMock(spec=MessageEvent)
+    event_mock.text = '!bot ping'
+    assert dummy_backend.is_mentioned(event_mock) == 'bot'
+    event_mock.text = 'abot. ping'
+    assert dummy_backend.is_mentioned(event_mock) == 'abot.'
+
+    dummy_backend.me = None
+    assert dummy_backend.is_mentioned(event_mock) is None
+
+
 def test_bot_object():
     obj = BotObject()
 
@@ -179,6 +202,7 @@ def test_bot_creation():
 
 def test_bot_attach_backend(bot: Bot, dummy_backend: DummyBackend):
     bot.attach_backend(dummy_backend)
+    assert dummy_backend.transport is bot.http
     with pytest.raises(ValueError):
         bot.attach_backend(dummy_backend)
 
@@ -210,6 +234,28 @@ def test_bot_attach_command_group(dummy_bot: Bot):
     assert main_group in dummy_bot.message_handlers
 
 
+def test_bot_command_collection(dummy_bot: Bot):
+    @cli.group()
+    async def first_group():
+        pass
+
+    @cli.group()
+    async def second_group():
+        pass
+
+    dummy_bot.attach_command_group(first_group)
+    collection = dummy_bot.command_collection
+    assert collection is dummy_bot.command_collection
+
+    # Attaching an already attached group keeps the collection
+    dummy_bot.attach_command_group(first_group)
+    assert collection is dummy_bot.command_collection
+
+    dummy_bot.attach_command_group(second_group)
+    assert collection is not dummy_bot.command_collection
+    assert set(dummy_bot.command_collection.sources) == {first_group, second_group}
+
+
 @pytest.mark.parametrize('is_mentioned', [True, False])
 @pytest.mark.asyncio
 async def test_bot_handle_message(
@@ -219,15 +265,17 @@ async def test_bot_handle_message(
         command_collection_mock: mock.MagicMock):
     m = mock.MagicMock(spec=MessageEvent)
     m.backend.is_mentioned.return_value = is_mentioned
+    dummy_bot.tasks.spawn = am.CoroutineMock()
     await dummy_bot._handle_message(m)
     m.backend.is_mentioned.assert_called_once_with(m)
     if not is_mentioned:
         assert len(asyncio_mock.mock_calls) == 0
+        dummy_bot.tasks.spawn.assert_not_awaited()
     else:
         command_collection_mock.assert_called_once_with(sources=dummy_bot.message_handlers)
         cmd = command_collection_mock.return_value
         cmd.async_message.assert_called_once_with(m)
-        assert len(asyncio_mock.ensure_future.mock_calls) == 1
+        dummy_bot.tasks.spawn.assert_awaited_once_with(cmd.async_message.return_value, key=Bot.COMMANDS_TASK_KEY)
 
 
 def test_bot_add_event_handler(dummy_bot):
@@ -263,9 +311,10 @@ def test_bot_add_event_handler(dummy_bot):
     (DummyMessageEvent, DummyMessageEvent),
 ])
 @pytest.mark.asyncio
-async def test_bot_handle_event(dummy_bot: Bot, event_class, listener_class, asyncio_mock):
+async def test_bot_handle_event(dummy_bot: Bot, event_class, listener_class):
     dummy_bot._handle_message = am.CoroutineMock()
-    dummy_bot.run_event = am.CoroutineMock()
+    dummy_bot.run_event = mock.MagicMock()
+    dummy_bot.tasks.spawn = am.CoroutineMock()
 
     dummy_bot.add_event_handler(event_class_or_func=listener_class, func=async_handler_func)
 
@@ -277,16 +326,36 @@ async def test_bot_handle_event(dummy_bot: Bot, event_class, listener_class, asy
         dummy_bot._handle_message.assert_awaited_once_with(event)
     if issubclass(listener_class, MessageEvent) and not issubclass(event_class, MessageEvent):
         dummy_bot.run_event.assert_not_called()
-        dummy_bot.run_event.assert_not_awaited()
+        dummy_bot.tasks.spawn.assert_not_awaited()
     else:  # listener_class is Event
         dummy_bot.run_event.assert_called_once_with(async_handler_func, event)
-        asyncio_mock.ensure_future.assert_called_once()
+        dummy_bot.tasks.spawn.assert_awaited_once_with(dummy_bot.run_event.return_value, key=async_handler_func)
+
+
+def test_bot_get_event_handlers(dummy_bot: Bot):
+    async def event_handler(event: Event):
+        pass
+
+    async def message_handler(event: DummyMessageEvent):
+        pass
+
+    dummy_bot.add_event_handler(func=event_handler)
+    assert dummy_bot.get_event_handlers(DummyMessageEvent) == (event_handler,)
+    assert dummy_bot.get_event_handlers(DummyEvent) == (event_handler,)
+    assert set(dummy_bot.event_dispatch) == {DummyMessageEvent, DummyEvent}
+
+    # Registering a handler invalidates the dispatch table
+    dummy_bot.add_event_handler(func=message_handler)
+    assert dummy_bot.event_dispatch == {}
+    assert dummy_bot.get_event_handlers(DummyMessageEvent) == (message_handler, event_handler)
+    assert dummy_bot.get_event_handlers(DummyEvent) == (event_handler,)
 
 
 @pytest.mark.asyncio
 async def test_bot__run_forever(dummy_bot: Bot, dummy_backend: DummyBackend):
     dummy_backend.initialize = am.CoroutineMock()
     dummy_backend.events = [Event(), Event(), Abort()]
+    dummy_backend.shutdown = am.CoroutineMock()
     dummy_bot.internal_exception_handler = am.CoroutineMock(return_value=False)
     e = Exception()
     dummy_bot._handle_event = am.CoroutineMock(side_effect=[True, e])
@@ -294,11 +363,95 @@ async def test_bot__run_forever(dummy_bot: Bot, dummy_backend: DummyBackend):
     await dummy_bot._run_forever()
 
     dummy_backend.initialize.assert_called_once_with()
+    dummy_backend.shutdown.assert_awaited_once_with()
     assert dummy_bot._handle_event.mock_calls == [mock.call(event=dummy_backend.events[0]),
                                                   mock.call(event=dummy_backend.events[1])]
     dummy_bot.internal_exception_handler.assert_awaited_once_with(e)
 
 
+@pytest.mark.asyncio
+async def test_bot__run_forever_backend_failure(dummy_bot: Bot, dummy_backend: DummyBackend):
+    dummy_backend.initialize = am.CoroutineMock()
+    dummy_backend.events = [Event(), Abort()]
+    dummy_bot.internal_exception_handler = am.CoroutineMock(return_value=True)
+    dummy_bot._handle_event = am.CoroutineMock()
+    e = Exception()
+
+    async def failing_consume():
+        raise e
+        yield
+
+    dummy_bot.backends[dummy_backend] = failing_consume()
+
+    with pytest.raises(Abort):
+        await dummy_bot._run_forever()
+
+    dummy_bot.internal_exception_handler.assert_awaited_once_with(e)
+    # Events keep being consumed after the failure
+    dummy_bot._handle_event.assert_awaited_once_with(event=dummy_backend.events[0])
+
+
+@pytest.mark.asyncio
+async def test_bot__run_forever_sync_executor(dummy_bot: Bot, dummy_backend: DummyBackend):
+    dummy_backend.events = [Event(), Abort()]
+    executors = []
+
+    async def handle_event(event):
+        executors.append(cli.get_sync_executor())
+
+    dummy_bot._handle_event = handle_event
+    shared_executor = cli.get_sync_executor()
+
+    with pytest.raises(Abort):
+        await dummy_bot._run_forever()
+
+    # The Bot runs sync commands in its own executor, and only shuts that one down
+    bot_executor, = executors
+    assert bot_executor is not shared_executor
+    with pytest.raises(RuntimeError):
+        bot_executor.submit(print)
+    assert cli.get_sync_executor() is shared_executor
+    shared_executor.submit(print).result()
+
+
+@pytest.mark.asyncio
+async def test_bot__run_forever_tasks_in_flight(dummy_bot: Bot, dummy_backend: DummyBackend):
+    dummy_backend.events = [Event(), Abort()]
+    dummy_backend.shutdown = am.CoroutineMock()
+    handler_states = []
+
+    async def handler(event):
+        try:
+            await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            # The backend and the sync executor are still available while the handler stops
+            handler_states.append((dummy_backend.shutdown.await_count, cli.get_sync_executor().submit(int).result()))
+            raise
+
+    dummy_bot.event_handlers[handler] = (Event,)
+
+    with pytest.raises(Abort):
+        await dummy_bot._run_forever()
+
+    assert handler_states == [(0, 0)]
+    assert dummy_bot.tasks.in_flight() == 0
+    dummy_backend.shutdown.assert_awaited_once_with()
+
+
+@pytest.mark.asyncio
+async def test_bot__run_forever_cancel(dummy_bot: Bot, dummy_backend: DummyBackend):
+    dummy_backend.events = [Event()]
+    dummy_bot.internal_exception_handler = am.CoroutineMock(return_value=True)
+
+    running = asyncio.ensure_future(dummy_bot._run_forever())
+    await asyncio.sleep(0.01)
+    running.cancel()
+
+    with pytest.raises(asyncio.CancelledError):
+        await running
+    dummy_bot.internal_exception_handler.assert_not_awaited()
+
+
 @pytest.mark.asyncio
 async def test_bot_run_forever(dummy_bot: Bot):
     rf = dummy_bot._run_forever = am.CoroutineMock()
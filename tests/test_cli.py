@@ -1,11 +1,173 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, print_function, unicode_literals
 
+import asyncio
+import threading
 import unittest.mock as mock
 
+import asynctest as am
+import click
 import pytest
 
 from abot import cli
+from abot.bot import current_event
+from abot.dubtrack import DubtrackBotBackend, DubtrackChannel, DubtrackMessage
+
+
+def test_command_collection_index():
+    @cli.group()
+    def first(): pass
+
+    @cli.group()
+    def second(): pass
+
+    @first.command()
+    async def ping(): pass
+
+    cmd_collection = cli.CommandCollection(sources=[first, second])
+    assert cmd_collection.command_index == {'ping': ping}
+    assert cmd_collection.get_command(None, 'ping') is ping
+    assert cmd_collection.get_command(None, 'pong') is None
+
+    # Attaching commands to a source invalidates the index
+    @second.command()
+    async def pong(): pass
+
+    assert cmd_collection.command_index == {'ping': ping, 'pong': pong}
+    assert cmd_collection.get_command(None, 'pong') is pong
+
+
+@pytest.mark.asyncio
+async def test_command_collection_deferred_replies():
+    @cli.group()
+    def acmds(): pass
+
+    @acmds.command()
+    async def ping(): pass
+
+    cmd_collection = cli.CommandCollection(sources=[acmds])
+
+    async def message(text):
+        message_mock = mock.MagicMock(text=text)
+        message_mock.reply_max_length = None
+        message_mock.reply = am.CoroutineMock()
+        current_event.set(message_mock)
+        await cmd_collection.async_message(message_mock)
+        return message_mock
+
+    ping_help, bot_help = await asyncio.gather(message('bot ping --help'), message('bot --help'))
+
+    ping_help.reply.assert_awaited_once()
+    assert ping_help.reply.call_args[0][0].startswith('Usage: bot ping')
+    bot_help.reply.assert_awaited_once()
+    assert bot_help.reply.call_args[0][0].startswith('Usage: bot [OPTIONS] COMMAND')
+    assert cli.deferred_replies.get() is None
+
+
+@pytest.mark.asyncio
+async def test_command_collection_parse_cache(mocker):
+    @cli.group()
+    def acmds(): pass
+
+    calls = []
+
+    @acmds.command()
+    @click.option('--times', type=int, default=1)
+    @click.argument('song')
+    async def play(song, times):
+        calls.append((song, times, click.get_current_context().info_name))
+
+    @acmds.command()
+    @click.option('--volume', type=int, callback=lambda ctx, param, value: value)
+    async def volume(volume):
+        calls.append(volume)
+
+    cmd_collection = cli.CommandCollection(sources=[acmds])
+    make_context = mocker.spy(cmd_collection, 'make_context')
+
+    for _ in range(3):
+        await cmd_collection.async_message(mock.MagicMock(text='bot play "some song" --times 2'))
+    assert calls == [('some song', 2, 'play')] * 3
+    assert make_context.call_count == 1
+    assert len(cmd_collection.parse_cache) == 1
+
+    # Parameters with callbacks are parsed every time
+    await cmd_collection.async_message(mock.MagicMock(text='bot volume --volume 3'))
+    await cmd_collection.async_message(mock.MagicMock(text='bot volume --volume 3'))
+    assert calls[-2:] == [3, 3]
+    assert make_context.call_count == 3
+
+    # Changing the command tree invalidates the cache
+    @acmds.command()
+    async def skip(): pass
+
+    await cmd_collection.async_message(mock.MagicMock(text='bot play "some song" --times 2'))
+    assert make_context.call_count == 4
+
+
+def test_command_parser_schema():
+    @cli.command()
+    @click.option('--times', '-t', type=int, default=1)
+    @click.argument('song')
+    async def play(song, times): pass
+
+    ctx = play.make_context('play', ['-t', '3', 'song'])
+    assert ctx.params == {'song': 'song', 'times': 3}
+    parser = play.make_parser(ctx)
+    assert parser.ctx is ctx
+    assert play.make_parser(ctx)._long_opt is parser._long_opt
+    assert play.get_help_option(ctx) is play.get_help_option(ctx)
+
+    with pytest.raises(click.NoSuchOption):
+        play.make_context('play', ['--volume', '3', 'song'])
+
+    # Adding parameters builds the parser again
+    click.option('--volume', type=int)(play)
+    assert play.make_context('play', ['--volume', '3', 'song']).params['volume'] == 3
+
+
+@pytest.mark.asyncio
+async def test_command_collection_help_blocks():
+    @cli.group()
+    def acmds(): pass
+
+    @acmds.command()
+    async def ping():
+        """Answer with pong"""
+
+    cmd_collection = cli.CommandCollection(sources=[acmds])
+    backend = DubtrackBotBackend('room')
+    backend.dubtrack_id = '560b135c7ae1ea0300869b21'
+    backend.dubtrackws.say_in_room = am.CoroutineMock()
+    message = DubtrackMessage({'type': 'chat-message', 'message': 'bot --help',
+                               'user': {'username': 'txomon', 'userInfo': {'userid': '560b135c7ae1ea0300869b20'}}},
+                              backend)
+    with mock.patch.multiple(DubtrackChannel, SAY_RATE=1000, SAY_BURST=1000):
+        message.channel = DubtrackChannel({'_id': 'room', 'name': 'room', 'roomUrl': 'room'}, backend)
+    message.channel.SAY_MAX_LENGTH = 40
+    current_event.set(message)
+
+    await cmd_collection.async_message(message)
+    await message.channel._sender
+    help_text = cmd_collection.get_help(cmd_collection.make_context('bot', ['ping']))
+    sent = [call[0][0] for call in backend.dubtrackws.say_in_room.call_args_list]
+    assert len(sent) > len(help_text.splitlines())
+    # The sender is mentioned once, and lines too long for a chat message are split
+    assert sent[0].startswith('@txomon: Usage: ')
+    assert not any('@txomon' in text for text in sent[1:])
+    assert all(len(text) <= 40 for text in sent)
+    sent_text = ''.join(sent)[len('@txomon: '):]
+    assert ''.join(sent_text.split()) == ''.join(help_text.split())
+
+    # The help is kept until the command tree changes
+    ctx = cmd_collection.make_context('bot', ['ping'])
+    assert cmd_collection.get_help(ctx) is help_text
+
+    @acmds.command()
+    async def pong():
+        """Answer with ping"""
+
+    assert 'Answer with ping' in cmd_collection.get_help(ctx)
 
 
 # Integration tests
@@ -50,7 +212,6 @@ def test_simple_cli_async_command():
     ping_mock.assert_called_once_with()
 
 
-@pytest.mark.skip('Not supported: Sync command in cli interface')
 def test_simple_cli_sync_command():
     @cli.group()
     def acmds(): pass
@@ -67,8 +228,8 @@ def test_simple_cli_sync_command():
     ping_mock.assert_called_once_with()
 
 
-@pytest.mark.skip('Not supported: Sync command in bot interface')
-def test_simple_bot_sync_command():
+@pytest.mark.asyncio
+async def test_simple_bot_sync_command():
     """Test sync command through bot interface"""
     message_mock = mock.MagicMock()
     message_mock.text = 'bot ping'
@@ -79,11 +240,35 @@ def test_simple_bot_sync_command():
     ping_mock = mock.MagicMock()
 
     @acmds.command()
-    async def ping(*args, **kwargs):
-        ping_mock(*args, **kwargs)
+    @click.pass_context
+    def ping(ctx, *args, **kwargs):
+        ping_mock(ctx.info_name, threading.current_thread(), *args, **kwargs)
 
     cmd_collection = cli.CommandCollection(sources=[acmds])
 
-    cmd_collection.async_message(message_mock)
+    await cmd_collection.async_message(message_mock)
 
-    ping_mock.assert_called_once_with()
+    ping_mock.assert_called_once_with('ping', mock.ANY)
+    assert ping_mock.call_args[0][1] is not threading.main_thread()
+
+
+@pytest.mark.asyncio
+async def test_command_async_main():
+    @cli.group()
+    async def acmds(): pass
+
+    @acmds.command()
+    @click.argument('name')
+    async def ping(name):
+        return f'pong {name}'
+
+    @acmds.command()
+    def pong():
+        return 'ping'
+
+    assert await acmds.async_main(['ping', 'txomon'], prog_name='bot') == 'pong txomon'
+    assert await acmds.async_main(['pong'], prog_name='bot') == 'ping'
+
+    # Sync entry points refuse to nest event loops
+    with pytest.raises(RuntimeError):
+        acmds.main(['pong'], standalone_mode=False)
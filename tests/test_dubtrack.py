@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, print_function, unicode_literals
 
+import gc
+import json
+import logging
+import pprint
+import unittest.mock as mock
+
 import asynctest as am
 import pytest
-import unittest.mock as mock
 
 from abot import dubtrack
 
@@ -30,7 +35,8 @@ async def test_dubtrack_channel():
     backend._register_user.assert_called_once_with(data)
 
     backend.dubtrackws.say_in_room = am.CoroutineMock()
-    await channel.say('hello')
+    delivered = await channel.say('hello')
+    await delivered
     backend.dubtrackws.say_in_room.assert_called_once_with('hello')
 
     backend.dubtrack_id = None
@@ -49,6 +55,48 @@ async def test_dubtrack_channel():
     assert repr(channel)
 
 
+@pytest.mark.asyncio
+async def test_dubtrack_channel_say_queue():
+    data, backend = mock.MagicMock(), mock.MagicMock()
+    channel = dubtrack.DubtrackChannel(data, backend)
+    backend.dubtrackws.say_in_room = am.CoroutineMock(side_effect=[None, None, Exception(), None, None])
+
+    first = await channel.say('line 1\nline 2')
+    failing = await channel.say('line 3\nline 4')
+    last = await channel.say('line 5')
+
+    await first
+    with pytest.raises(Exception):
+        await failing
+    await last
+    # The rest of the lines of a failed text are not sent
+    assert backend.dubtrackws.say_in_room.mock_calls == [
+        mock.call('line 1'), mock.call('line 2'), mock.call('line 3'), mock.call('line 5'),
+    ]
+
+    assert channel._coalesce(['a', 'b', 'c']) == ['a', 'b', 'c']
+    channel.SAY_COALESCE_LENGTH = 4
+    assert channel._coalesce(['a', 'b', 'c', 'long line']) == ['a\nb', 'c', 'long line']
+
+
+@pytest.mark.asyncio
+async def test_dubtrack_channel_say_ignored_failure(event_loop):
+    data, backend = mock.MagicMock(), mock.MagicMock()
+    channel = dubtrack.DubtrackChannel(data, backend)
+    backend.dubtrackws.say_in_room = am.CoroutineMock(side_effect=Exception)
+    exception_handler = mock.Mock()
+    event_loop.set_exception_handler(exception_handler)
+
+    # Captured log records would keep the failure alive
+    with mock.patch.object(dubtrack, 'logger'):
+        await channel.say('hello')
+        await channel._sender
+    gc.collect()
+
+    # Nobody waited for the delivery, but asyncio has nothing to complain about
+    exception_handler.assert_not_called()
+
+
 @pytest.mark.parametrize('property_name', (
         'username',
         'id',
@@ -79,6 +127,7 @@ async def test_dubtrack_entity(property_name):
 
 @pytest.mark.parametrize('data,return_type', (
         ({'type': 'chat-message'}, dubtrack.DubtrackMessage),
+        ({'type': 'user_update_560b135c7ae1ea0300869b20', 'user': {}}, dubtrack.DubtrackUserUpdate),
         ({'type': 'bu'}, dubtrack.DubtrackEvent)
 ))
 def test_dubtrack_event_from_data(data, return_type):
@@ -91,6 +140,23 @@ def test_dubtrack_event_from_data(data, return_type):
     assert result._data == data
 
 
+def test_dubtrack_event_from_data_custom_class():
+    # Defining the class registers it, don't leak it to other tests
+    with mock.patch.dict(dubtrack.DubtrackEvent._event_classes):
+        class DubtrackCustomEvent(dubtrack.DubtrackEvent):
+            _data_type = 'test-custom-event'
+
+        backend = mock.MagicMock()
+
+        result = dubtrack.DubtrackEvent.from_data(data={'type': 'test-custom-event'}, dubtrack_backend=backend)
+        assert isinstance(result, DubtrackCustomEvent)
+
+        # Only subclasses of the class used are returned
+        result = dubtrack.DubtrackMessage.from_data(data={'type': 'test-custom-event'}, dubtrack_backend=backend)
+        assert type(result) is dubtrack.DubtrackMessage
+    assert 'test-custom-event' not in dubtrack.DubtrackEvent._event_classes
+
+
 @pytest.mark.asyncio
 async def test_dubtrack_event():
     data, backend = mock.MagicMock(), mock.MagicMock()
@@ -286,3 +352,115 @@ async def test_dubtrack_room_queue_reorder():
 @pytest.mark.asyncio
 async def test_dubtrack_user_queue_update():
     pass
+
+
+def test_trace_payload():
+    payload = {'data': list(range(100))}
+    assert str(dubtrack.TracePayload(payload)) == pprint.pformat(payload)
+
+    truncated = str(dubtrack.TracePayload(payload, limit=10))
+    assert truncated.startswith("{'data': [")
+    assert truncated.endswith('characters more)')
+
+
+@pytest.mark.parametrize('method,args', (
+        ('api_get', ('url',)),
+        ('api_post', ('url', {'a': 1})),
+        ('api_delete', ('url',)),
+))
+@pytest.mark.asyncio
+async def test_dubtrack_ws_api_request(method, args):
+    dubtrackws = dubtrack.DubtrackWS('room')
+    dubtrackws.aio_session = mock.MagicMock()
+    response = mock.MagicMock()
+    response.json = am.CoroutineMock(return_value={'data': 'value'})
+    request_cm = dubtrackws.aio_session.request.return_value
+    request_cm.__aenter__ = am.CoroutineMock(return_value=response)
+    request_cm.__aexit__ = am.CoroutineMock(return_value=False)
+
+    assert await getattr(dubtrackws, method)(*args) == 'value'
+
+    verb = method[len('api_'):].upper()
+    body = args[1] if len(args) > 1 else None
+    dubtrackws.aio_session.request.assert_called_once_with(verb, 'url', json=body)
+
+
+def test_dubtrack_user_registry():
+    registry = dubtrack.DubtrackUserRegistry()
+    user = registry.update('1234', {'username': 'Txomon'})
+
+    assert user == {'id': '1234', 'username': 'Txomon'}
+    assert list(registry) == ['1234']
+    assert len(registry) == 1
+    assert '1234' in registry
+    assert registry.get('1234') is user
+    assert registry.get('txomon') is user
+    assert registry.get('TXOMON') is user
+    assert registry.get(None) is None
+    assert registry.get('nobody') is None
+
+    # Updates happen in place, and keep the username index
+    assert registry.update('1234', {'username': 'javier', 'dubs': 3}) is user
+    assert user['dubs'] == 3
+    assert registry.get('txomon') is None
+    assert registry.get('Javier') is user
+
+
+def test_dubtrack_backend_register_user():
+    backend = dubtrack.DubtrackBotBackend('room')
+    backend._register_user({'userid': '1234', 'username': 'txomon', 'dubs': 3})
+
+    entity = backend._get_entity('txomon')
+    assert entity.id == '1234'
+    assert entity.dubs == 3
+    assert backend._get_entity('1234') is entity
+
+    backend._register_user({'userid': '1234', 'skippedCount': 2})
+    assert entity.skips == 2
+
+
+def dubtrack_room_frame(content):
+    envelope = {'action': 15, 'message': {'type': 'json', 'name': content['type'], 'data': json.dumps(content)}}
+    return f'4{json.dumps(envelope)}'
+
+
+def test_dubtrack_frame_decoder(caplog, mocker):
+    dubtrackws = dubtrack.DubtrackWS('room')
+    decoder = dubtrackws.frame_decoder
+
+    for control_frame in ('0{"pingInterval": 25000}', '3', '2', '9'):
+        assert decoder.decode(control_frame) is None
+
+    assert decoder.decode('4{"action": 4, "clientId": "client", "connectionId": "connection"}') is None
+    assert dubtrackws.connection_id == 'connection'
+
+    presence = {'action': 14, 'presence': {'action': 0, 'clientId': 'other', 'connectionId': 'other-conn'}}
+    assert decoder.decode(f'4{json.dumps(presence)}') is None
+    assert dubtrackws.connected_clients['other'] == {'other-conn'}
+    presence['presence']['action'] = 1
+    decoder.decode(f'4{json.dumps(presence)}')
+    assert dubtrackws.connected_clients['other'] == set()
+
+    skip = {'type': 'chat-skip', 'username': 'txomon'}
+    debug_log = mocker.spy(dubtrack.logger_layer3, 'debug')
+    with caplog.at_level(logging.INFO, logger='abot.dubtrack.layer3'):
+        assert decoder.decode(dubtrack_room_frame(skip)) == skip
+    debug_log.assert_not_called()
+    with caplog.at_level(logging.DEBUG, logger='abot.dubtrack.layer3'):
+        assert decoder.decode(dubtrack_room_frame(skip)) == skip
+    debug_log.assert_called_once_with('Chat-skip by txomon')
+
+    # Describing unexpected payloads does not break decoding
+    with caplog.at_level(logging.DEBUG, logger='abot.dubtrack.layer3'):
+        assert decoder.decode(dubtrack_room_frame({'type': 'user-join'})) == {'type': 'user-join'}
+
+    chat = {'type': 'chat-message', 'message': 'hello'}
+    dubtrackws.suppress_messages.append('hello')
+    assert decoder.decode(dubtrack_room_frame(chat)) is None
+    assert decoder.decode(dubtrack_room_frame(chat)) == chat
+
+
+def test_dubtrack_get_content_describer():
+    assert dubtrack.get_content_describer('chat-skip') is dubtrack.describe_chat_skip
+    assert dubtrack.get_content_describer('user_update_560b135c') is dubtrack.describe_user_update
+    assert dubtrack.get_content_describer('unknown') is None
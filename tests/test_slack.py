@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+
+import asyncio
+
+import asynctest as am
+import pytest
+from aiohttp import WSMsgType
+
+from abot.slack import SlackAckException, SlackAckTracker, SlackAPI, SlackCallException, SlackEntityStore, \
+    SlackRateLimitedException, SlackUseException
+from abot.util import json_codec
+
+
+@pytest.fixture
+def slack_api(mocker):
+    mocker.patch('abot.slack.aiohttp')
+    return SlackAPI('xoxb-token')
+
+
+def test_slack_entity_store():
+    general = {'id': 'C1', 'name': 'general'}
+    random = {'id': 'C2', 'name': 'random'}
+    store = SlackEntityStore([general, random])
+
+    assert len(store) == 2
+    assert list(store) == [general, random]
+    assert 'C1' in store
+    assert store.get('C1') is general
+    assert store.get('C3') is None
+    assert store.find_by_name('general') == [general]
+
+    # Renaming keeps the name index in sync
+    store.update('C1', {'name': 'announcements'})
+    assert store.find_by_name('general') == []
+    assert store.find_by_name('announcements') == [general]
+
+    # Updating unknown entities adds them
+    store.update('C3', {'name': 'random'})
+    assert {c['id'] for c in store.find_by_name('random')} == {'C2', 'C3'}
+
+    # Adding an existing id replaces the entity
+    new_random = {'id': 'C2', 'name': 'dev'}
+    store.add(new_random)
+    assert store.get('C2') is new_random
+    assert store.find_by_name('random') == [store.get('C3')]
+
+
+@pytest.mark.asyncio
+async def test_slack_api_load_snapshot(slack_api: SlackAPI):
+    slack_api.users.add({'id': 'U1', 'presence': 'active'})
+    slack_api.call = am.CoroutineMock(side_effect=[
+        {'ok': True, 'members': [{'id': 'U1', 'name': 'txomon'}], 'response_metadata': {'next_cursor': 'abc'}},
+        {'ok': True, 'members': [
+            {'id': 'U2', 'name': 'dtgoitia'},
+            {'id': 'U3', 'name': 'abot', 'is_bot': True, 'profile': {'bot_id': 'B1', 'api_app_id': 'A1'}},
+        ], 'response_metadata': {'next_cursor': ''}},
+        {'ok': True, 'channels': [
+            {'id': 'C1', 'name': 'general', 'is_channel': True},
+            {'id': 'G1', 'name': 'secret', 'is_private': True},
+            {'id': 'D1', 'user': 'U1', 'is_im': True},
+            {'id': 'G2', 'name': 'mpdm-txomon--dtgoitia-1', 'is_mpim': True},
+        ]},
+    ])
+
+    await slack_api.load_snapshot()
+
+    assert slack_api.call.mock_calls[1][2]['cursor'] == 'abc'
+    assert slack_api.users.get('U1') == {'id': 'U1', 'name': 'txomon', 'presence': 'active'}
+    assert slack_api.users.find_by_name('dtgoitia')
+    assert 'C1' in slack_api.channels
+    assert 'G1' in slack_api.groups
+    assert 'D1' in slack_api.ims
+    assert 'G2' in slack_api.mpims
+    assert slack_api.bots.get('B1') == {'id': 'B1', 'name': 'abot', 'deleted': False, 'app_id': 'A1'}
+
+
+@pytest.mark.asyncio
+async def test_slack_api_lazy_name_resolution(slack_api: SlackAPI):
+    loaded = asyncio.Event()
+
+    async def load_snapshot():
+        await loaded.wait()
+        slack_api.users.add({'id': 'U1', 'name': 'txomon'})
+
+    slack_api.snapshot_loader = asyncio.ensure_future(load_snapshot())
+    resolving = asyncio.ensure_future(slack_api.lookup_name('@txomon'))
+    await asyncio.sleep(0)
+    assert not resolving.done()
+
+    loaded.set()
+    assert await resolving == 'U1'
+    with pytest.raises(SlackUseException):
+        await slack_api.lookup_name('@dtgoitia')
+
+
+@pytest.mark.asyncio
+async def test_slack_api_snapshot_loader_failure(slack_api: SlackAPI, mocker):
+    logger_mock = mocker.patch('abot.slack.logger')
+    slack_api.lazy_snapshot = True
+    slack_api.call = am.CoroutineMock(return_value={'ok': True, 'url': 'wss://rtm'})
+    slack_api.load_snapshot = am.CoroutineMock(side_effect=SlackCallException('failed', method='users.list'))
+
+    assert await slack_api.rtm_connect() == 'wss://rtm'
+    await asyncio.wait([slack_api.snapshot_loader])
+    await asyncio.sleep(0)
+
+    logger_mock.error.assert_called_once()
+    # The next connection loads it again
+    assert not slack_api.snapshot_taken
+
+
+@pytest.mark.asyncio
+async def test_slack_api_fetch_user(slack_api: SlackAPI):
+    slack_api.users.add({'id': 'U1', 'presence': 'active'})
+    slack_api.call = am.CoroutineMock(return_value={'ok': True, 'user': {'id': 'U1', 'name': 'txomon'}})
+
+    assert (await slack_api.fetch_user('U1'))['name'] == 'txomon'
+    assert (await slack_api.fetch_user('U1'))['presence'] == 'active'
+    slack_api.call.assert_awaited_once_with('users.info', user='U1')
+
+
+@pytest.mark.asyncio
+async def test_slack_api_call_deduplication(slack_api: SlackAPI):
+    release = asyncio.Event()
+
+    async def direct_call(method, **params):
+        await release.wait()
+        return {'ok': True, 'channel': {'id': f'D{params.get("user")}'}}
+
+    slack_api.direct_call = am.CoroutineMock(side_effect=direct_call)
+    calls = asyncio.gather(slack_api.create_im('U1'), slack_api.create_im('U1'), slack_api.create_im('U2'))
+    await asyncio.sleep(0)
+    release.set()
+    first, second, third = await calls
+
+    assert first is second
+    assert third['channel']['id'] == 'DU2'
+    assert slack_api.direct_call.await_count == 2
+    assert slack_api.pending_calls == {}
+
+    # Methods with side effects are always sent
+    release.clear()
+    slack_api.direct_call.reset_mock()
+    calls = asyncio.gather(slack_api.call('chat.postMessage', channel='C1', text='hello'),
+                           slack_api.call('chat.postMessage', channel='C1', text='hello'))
+    await asyncio.sleep(0)
+    release.set()
+    await calls
+    assert slack_api.direct_call.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_slack_api_call_rate_limited(slack_api: SlackAPI):
+    slack_api.RATE_LIMIT_RETRIES = 1
+    rate_limited = SlackRateLimitedException('Rate limited', method='users.info', retry_after=0.01)
+    slack_api.direct_call = am.CoroutineMock(side_effect=[rate_limited, {'ok': True}])
+
+    assert await slack_api.call('users.info', user='U1') == {'ok': True}
+    assert slack_api.direct_call.await_count == 2
+
+    slack_api.direct_call = am.CoroutineMock(side_effect=[rate_limited, rate_limited])
+    with pytest.raises(SlackRateLimitedException):
+        await slack_api.call('users.info', user='U1')
+
+
+@pytest.mark.asyncio
+async def test_slack_api_im_resolution_cache(slack_api: SlackAPI):
+    slack_api.ims.add({'id': 'D1', 'user': 'U1', 'is_im': True})
+    slack_api.call = am.CoroutineMock(return_value={'ok': True, 'channel': {'id': 'D2'}})
+
+    assert await slack_api.slack_name_to_id('U1') == 'D1'
+    assert await slack_api.slack_name_to_id('U2') == 'D2'
+    assert await slack_api.slack_name_to_id('U2') == 'D2'
+    assert slack_api.call.await_count == 1
+    assert slack_api.im_by_user == {'U1': 'D1', 'U2': 'D2'}
+
+    slack_api.handle_im_close({'type': 'im_close', 'channel': 'D1'})
+    assert slack_api.im_by_user == {'U2': 'D2'}
+    assert slack_api.conversation_keys == {'D2': {'U2'}}
+    slack_api.handle_im_created({'type': 'im_created', 'channel': {'id': 'D3', 'user': 'U2'}})
+    assert slack_api.im_by_user == {}
+    assert slack_api.conversation_keys == {}
+    assert await slack_api.slack_name_to_id('U2') in ('D2', 'D3')
+
+
+@pytest.mark.asyncio
+async def test_slack_api_mpim_resolution_cache(slack_api: SlackAPI):
+    slack_api.mpims.add({'id': 'G1', 'members': ['U2', 'U1'], 'is_mpim': True})
+    slack_api.call = am.CoroutineMock(return_value={'ok': True, 'group': {'id': 'G2', 'members': ['U1', 'U3']}})
+    userids = ['U2', 'U1']
+
+    assert await slack_api.userids_to_channel(userids) == 'G1'
+    assert userids == ['U2', 'U1']
+    assert await slack_api.userids_to_channel(['U3', 'U1']) == 'G2'
+    assert await slack_api.userids_to_channel(['U1', 'U3']) == 'G2'
+    slack_api.call.assert_awaited_once_with('mpim.open', users='U1,U3')
+    assert 'G2' in slack_api.mpims
+
+    slack_api.handle_member_left_channel({'type': 'member_left_channel', 'channel': 'G1', 'channel_type': 'G',
+                                          'user': 'U2'})
+    assert slack_api.mpim_by_members == {frozenset(['U1', 'U3']): 'G2'}
+    assert slack_api.conversation_keys == {'G2': {frozenset(['U1', 'U3'])}}
+
+
+@pytest.mark.asyncio
+async def test_slack_ack_tracker():
+    tracker = SlackAckTracker(timeout=0.01, window=2)
+    first, second = tracker.track(1), tracker.track(2)
+    assert tracker.outstanding == 2
+
+    waiter = asyncio.ensure_future(tracker.wait_available())
+    await asyncio.sleep(0)
+    assert not waiter.done()
+
+    assert tracker.resolve(1, {'ok': True, 'reply_to': 1})
+    assert not tracker.resolve(1, {'ok': True, 'reply_to': 1})
+    await asyncio.wait_for(waiter, 1)
+    assert first.result() == {'ok': True, 'reply_to': 1}
+
+    # Unacknowledged messages expire
+    with pytest.raises(SlackAckException):
+        await asyncio.wait_for(second, 1)
+
+    third = tracker.track(3)
+    tracker.fail_all('websocket closed')
+    with pytest.raises(SlackAckException):
+        await third
+    assert tracker.metrics() == {
+        'outstanding': 0, 'acked': 1, 'failed': 2,
+        'latency_mean': tracker.latency_total, 'latency_max': tracker.latency_total,
+    }
+
+
+@pytest.mark.asyncio
+async def test_slack_api_rtm_handler_reply(slack_api: SlackAPI):
+    slack_api.ws_socket = am.MagicMock(closed=False, send_json=am.CoroutineMock())
+    future = await slack_api.ws_send({'type': 'message', 'channel': 'C1', 'text': 'hi'})
+    slack_api.ws_socket.send_json.assert_awaited_once()
+
+    reply = am.MagicMock(data='{"ok": true, "reply_to": 1, "ts": "1.0"}')
+    assert slack_api.rtm_handler(reply) is None
+    assert future.result()['ts'] == '1.0'
+    assert slack_api.acks.outstanding == 0
+
+    # A message that cannot be sent is not waited for
+    slack_api.ws_socket.send_json.side_effect = ConnectionResetError()
+    with pytest.raises(ConnectionResetError):
+        await slack_api.ws_send({'type': 'message', 'channel': 'C1', 'text': 'hi'})
+    assert slack_api.acks.outstanding == 0
+    assert slack_api.acks.failed == 1
+
+
+class FakeWebSocket:
+    def __init__(self, *frames):
+        self.frames = list(frames)
+        self.closed = False
+        self.close_calls = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.closed = True
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.closed or not self.frames:
+            raise StopAsyncIteration
+        return am.MagicMock(tp=WSMsgType.text, data=self.frames.pop(0))
+
+    async def close(self):
+        self.close_calls += 1
+        self.closed = True
+
+
+@pytest.mark.asyncio
+async def test_slack_api_rtm_reconnect(slack_api: SlackAPI):
+    slack_api.call = am.CoroutineMock(side_effect=[
+        {'ok': True, 'url': 'wss://first', 'channels': [], 'groups': [], 'ims': [], 'mpims': [],
+         'users': [{'id': 'U1', 'name': 'txomon'}], 'bots': []},
+        {'ok': True, 'url': 'wss://third'},
+    ])
+    sockets = {
+        'wss://first': FakeWebSocket('{"type": "reconnect_url", "url": "wss://second"}', '{"type": "goodbye"}'),
+        'wss://second': FakeWebSocket('{"type": "hello"}'),
+        'wss://third': FakeWebSocket('{"type": "hello"}'),
+    }
+    slack_api.session.closed = False
+    slack_api.session.close = am.CoroutineMock()
+    slack_api.session.ws_connect = lambda url: sockets[url]
+    slack_api.reconnect_delay = lambda failures: 0
+
+    consumer = slack_api.rtm_api_consume()
+    received = [(await consumer.__anext__())['type'] for _ in range(4)]
+    await consumer.aclose()
+
+    assert received == ['reconnect_url', 'goodbye', 'hello', 'hello']
+    assert sockets['wss://first'].close_calls == 1
+    # The session is not shared, so it is closed when the consumer stops
+    slack_api.session.close.assert_awaited_once_with()
+    assert [c[1][0] for c in slack_api.call.mock_calls] == ['rtm.start', 'rtm.connect']
+    assert slack_api.users.get('U1')['name'] == 'txomon'
+
+
+def test_slack_api_reconnect_delay(slack_api: SlackAPI):
+    assert slack_api.reconnect_delay(0) == 0
+    assert 0.5 <= slack_api.reconnect_delay(1) <= 1
+    assert 4 <= slack_api.reconnect_delay(4) <= 8
+    assert slack_api.reconnect_delay(100) <= slack_api.RECONNECT_BACKOFF_MAX
+
+
+def test_slack_api_rtm_handler_routes(mocker):
+    mocker.patch('abot.slack.aiohttp')
+    slack_api = SlackAPI('xoxb-token', ignore_types=['user_typing'])
+    slack_api.users.add({'id': 'U1', 'presence': 'away'})
+    json_loads = mocker.spy(json_codec, 'loads')
+
+    typing = am.MagicMock(data='{"type": "user_typing", "channel": "C1", "user": "U1"}')
+    assert slack_api.rtm_handler(typing) is None
+    json_loads.assert_not_called()
+
+    presence = am.MagicMock(data='{"type": "presence_change", "user": "U1", "presence": "active"}')
+    assert slack_api.rtm_handler(presence)['presence'] == 'active'
+    assert slack_api.users.get('U1')['presence'] == 'active'
+
+    message = am.MagicMock(data='{"type": "message", "channel": "C1", "text": "hi"}')
+    assert slack_api.rtm_handler(message)['text'] == 'hi'
+
+
+@pytest.mark.asyncio
+async def test_slack_api_write_to_chunks(slack_api: SlackAPI):
+    slack_api.MAX_MESSAGE_LENGTH = 10
+    slack_api.ws_socket = am.MagicMock(closed=False, send_json=am.CoroutineMock())
+
+    future = await slack_api.write_to('C1', 'first line\nsecond\nthird')
+
+    assert slack_api.ws_socket.send_json.await_count == 3
+    sent = [call[1][0]['text'] for call in slack_api.ws_socket.send_json.mock_calls]
+    assert sent == ['first line', 'second', 'third']
+    assert slack_api.acks.pending[3][0] is future
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+
+import pytest
+
+from abot.transport import HttpTransport
+
+
+@pytest.mark.asyncio
+async def test_http_transport():
+    transport = HttpTransport(limit=10, limit_per_host=2, ttl_dns_cache=None)
+    connector = transport.connector
+    assert connector.limit == 10
+    assert connector.limit_per_host == 2
+    assert not connector.use_dns_cache
+
+    first, second = transport.session(), transport.session()
+    assert first.connector is second.connector is connector
+
+    await transport.close()
+    assert first.closed
+    assert second.closed
+    assert connector.closed
+
+    # The transport can still be used after being closed
+    assert transport.connector is not connector
+    await transport.close()
@@ -2,9 +2,11 @@
 from __future__ import absolute_import, print_function, unicode_literals
 
 import asyncio
+import json
+
 import pytest
 
-from abot.util import iterator_merge
+from abot.util import chunk_text, iterator_merge, IteratorMerger, JsonCodec, LRUCache, TaskRegistry, TokenBucket
 
 
 async def three_yields():
@@ -23,3 +25,140 @@ async def test_iterator_merge_normal():
     y1, y2 = three_yields(), three_yields()
     async for item in iterator_merge({y1: asyncio.ensure_future(y1.__anext__()), y2: None}):
         print(item)
+
+
+@pytest.mark.asyncio
+async def test_iterator_merger():
+    merger = IteratorMerger([three_yields(), three_yields()], maxsize=2, fair_share=1)
+    items = [item async for item in merger]
+    assert sorted(items) == [1, 1, 2, 2, 3, 3]
+
+
+@pytest.mark.asyncio
+async def test_iterator_merger_exception():
+    forever_finished = asyncio.Event()
+
+    async def forever():
+        try:
+            while True:
+                yield 0
+                await asyncio.sleep(0)
+        finally:
+            forever_finished.set()
+
+    merger = IteratorMerger([forever(), exception_yield()])
+    with pytest.raises(Exception):
+        async for _ in merger:
+            pass
+    # The rest of the sources are stopped
+    assert forever_finished.is_set()
+    assert merger.closed
+    with pytest.raises(RuntimeError):
+        async for _ in merger:
+            pass
+
+
+@pytest.mark.asyncio
+async def test_iterator_merger_resume():
+    merger = IteratorMerger([three_yields()])
+    items = []
+    with pytest.raises(ValueError):
+        async for item in merger:
+            items.append(item)
+            raise ValueError()
+    async for item in merger:
+        items.append(item)
+    assert items == [1, 2, 3]
+    await merger.aclose()
+
+
+@pytest.mark.asyncio
+async def test_task_registry_limits():
+    registry = TaskRegistry(limit=2, key_limit=1)
+    release = asyncio.Event()
+
+    async def blocked():
+        await release.wait()
+
+    await registry.spawn(blocked(), key='a')
+    assert registry.in_flight() == 1
+    assert registry.in_flight('a') == 1
+    assert registry.is_full('a')
+    assert not registry.is_full('b')
+
+    await registry.spawn(blocked(), key='b')
+    assert registry.is_full()
+
+    # Third spawn has to wait until something finishes
+    third = asyncio.ensure_future(registry.spawn(blocked(), key='c'))
+    await asyncio.sleep(0)
+    assert not third.done()
+
+    release.set()
+    task = await third
+    await task
+    await asyncio.sleep(0)  # Let done callbacks run
+    assert registry.in_flight() == 0
+    assert registry.in_flight('a') == 0
+
+
+@pytest.mark.asyncio
+async def test_task_registry_cancel_all():
+    registry = TaskRegistry()
+    await registry.cancel_all()
+
+    blocked = await registry.spawn(asyncio.Event().wait(), key='a')
+    finished = await registry.spawn(asyncio.sleep(0), key='b')
+    await finished
+
+    await registry.cancel_all()
+    assert blocked.cancelled()
+    assert not finished.cancelled()
+    assert registry.in_flight() == 0
+
+
+@pytest.mark.asyncio
+async def test_token_bucket():
+    bucket = TokenBucket(rate=100, capacity=2)
+    assert bucket.delay() == 0
+    await bucket.acquire()
+    await bucket.acquire()
+    assert 0 < bucket.delay() <= 0.01
+
+    bucket.pause(1)
+    assert 0.99 < bucket.delay() <= 1
+
+
+def test_json_codec(mocker):
+    frame = '{"type": "message", "text": "ábot", "ts": 1.5, "members": ["U1", "U2"]}'
+    for codec in (JsonCodec.stdlib(), JsonCodec.fastest()):
+        assert codec.loads(codec.dumps(codec.loads(frame))) == json.loads(frame)
+        assert isinstance(codec.dumps({}), str)
+
+    mocker.patch('abot.util.orjson', None)
+    assert JsonCodec.fastest().name == 'json'
+
+
+def test_lru_cache():
+    cache = LRUCache(maxsize=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+
+    assert 'b' not in cache
+    assert cache.get('b', 'missing') == 'missing'
+    assert len(cache) == 2
+    cache.clear()
+    assert cache.get('a') is None
+
+
+@pytest.mark.parametrize('text,limit,chunks', (
+    ('line\nline', None, ['line\nline']),
+    ('', 4, ['']),
+    ('a\nbb\nccc', 4, ['a\nbb', 'ccc']),
+    ('a\n\nb', 4, ['a\n\nb']),
+    ('abcdefghij\nk', 4, ['abcd', 'efgh', 'ij\nk']),
+))
+def test_chunk_text(text, limit, chunks):
+    assert chunk_text(text, limit) == chunks